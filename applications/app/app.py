@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 
 if "ab_step" not in st.session_state:
@@ -20,6 +23,8 @@ if "customer_details" not in st.session_state:
     st.session_state.customer_details = {} 
 
 API_URL = "http://api:8000"  # Adjust to your backend API's URL
+API_POOL_SIZE = 10  # Keep-alive connections kept open to the API
+DATA_CACHE_TTL = 60  # Seconds fetched API data is reused across reruns
 
 def reset_app():
     """
@@ -33,59 +38,141 @@ def reset_app():
     st.session_state.results_ready = False
     st.session_state.customer_details = {}
 
-def fetch_data(endpoint, filters=None):
+@st.cache_resource
+def get_api_session():
     """
-    Fetches data from the given API endpoint with optional filters.
+    Creates the HTTP session shared by every rerun and user, so connections to the API are kept alive and reused.
+
+    **Returns:**
+    - `requests.Session`: A session with a pool of `API_POOL_SIZE` connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=API_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_data(ttl=DATA_CACHE_TTL, show_spinner=False)
+def fetch_records(endpoint, params):
+    """
+    Fetches the records of an API endpoint, cached by endpoint and parameters for `DATA_CACHE_TTL` seconds.
 
     **Parameters:**
     - `endpoint (str)`: The API endpoint to fetch data from.
-    - `filters (dict, optional)`: A dictionary of filters to apply on the data.
+    - `params (dict)`: The query parameters of the request.
 
     **Returns:**
-    - `pd.DataFrame`: A pandas DataFrame with the fetched data. An empty DataFrame is returned in case of failure.
+    - `list`: The records returned by the API.
 
     **Raises:**
-    - `requests.exceptions.RequestException`: If there's an issue with the request, it raises an exception.
+    - `requests.exceptions.RequestException`: If the request fails; failures are not cached.
+    """
+    response = get_api_session().get(f"{API_URL}/{endpoint}/", params=params)
+    response.raise_for_status()
+    return response.json()
+
+def fetch_params(filters=None, fields=None):
+    """
+    Builds the query parameters of a list endpoint request.
+
+    **Parameters:**
+    - `filters (dict, optional)`: Column values the rows must match.
+    - `fields (str, optional)`: Comma-separated columns to fetch instead of whole rows.
+
+    **Returns:**
+    - `dict`: The query parameters.
+    """
+    params = dict(filters or {})
+    if fields:
+        params["fields"] = fields
+    return params
+
+def report_fetch_error(endpoint, error):
+    """
+    Shows why fetching an endpoint failed.
+
+    **Parameters:**
+    - `endpoint (str)`: The API endpoint that was fetched.
+    - `error (Exception)`: The error raised by the request.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        st.error(f"Failed to fetch data from {endpoint}: {error.response.status_code}")
+    else:
+        st.error(f"Error fetching data from {endpoint}: {error}")
+
+def fetch_data(endpoint, filters=None, fields=None):
+    """
+    Fetches data from the given API endpoint with optional filters.
+
+    The filters are applied by the API, so only matching rows are downloaded; keys that are not
+    columns of the endpoint are ignored. Responses are cached for `DATA_CACHE_TTL` seconds.
+
+    **Parameters:**
+    - `endpoint (str)`: The API endpoint to fetch data from.
+    - `filters (dict, optional)`: Column values the rows must match.
+    - `fields (str, optional)`: Comma-separated columns to fetch instead of whole rows.
+
+    **Returns:**
+    - `pd.DataFrame`: A pandas DataFrame with the fetched data. An empty DataFrame is returned in case of failure.
     """
     try:
-        response = requests.get(f"{API_URL}/{endpoint}/")
-        if response.status_code == 200:
-            data = pd.DataFrame(response.json())
-            if filters:
-                for key, value in filters.items():
-                    if key in data.columns:
-                        data = data[data[key].str.lower() == value.lower()]
-            return data
-        else:
-            st.error(f"Failed to fetch data from {endpoint}: {response.status_code}")
-            return pd.DataFrame()
+        return pd.DataFrame(fetch_records(endpoint, fetch_params(filters, fields)))
     except Exception as e:
-        st.error(f"Error fetching data from {endpoint}: {e}")
+        report_fetch_error(endpoint, e)
         return pd.DataFrame()
 
+def fetch_data_concurrently(*fetches):
+    """
+    Fetches several independent API endpoints in parallel, so a page waits for one round trip instead of one per endpoint.
+
+    **Parameters:**
+    - `*fetches (tuple)`: One `(endpoint, filters, fields)` tuple per request, as taken by `fetch_data`.
+
+    **Returns:**
+    - `list[pd.DataFrame]`: One DataFrame per request, in order. An empty DataFrame is returned for each failed request.
+    """
+    # Worker threads get the script context, so the cache treats their calls like the main thread's
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=len(fetches), initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        futures = [
+            executor.submit(fetch_records, endpoint, fetch_params(filters, fields))
+            for endpoint, filters, fields in fetches
+        ]
+
+    frames = []
+    for (endpoint, _, _), future in zip(fetches, futures):
+        try:
+            frames.append(pd.DataFrame(future.result()))
+        except Exception as e:
+            report_fetch_error(endpoint, e)
+            frames.append(pd.DataFrame())
+    return frames
+
 def get_max_experiment_id_data():
     """
-    Fetches A/B test results data and returns the rows with the maximum experiment ID.
+    Fetches the per-variant results summary of the latest experiment.
+
+    The counts are aggregated by the API, so the page loads in the same time whatever the
+    size of the experiment.
 
     **Parameters:**
     - No parameters.
 
     **Returns:**
-    - `pd.DataFrame`: The filtered data containing rows with the maximum experiment ID.
+    - `dict`: The `experiment_id`, `p_value` and `variants` (exposures, clicks and CTR of each variant)
+      of the experiment with the maximum experiment ID. An empty dict is returned in case of failure.
 
     **Raises:**
-    - `Exception`: If no data is fetched or the dataset is empty, an error is logged.
+    - `Exception`: If no data is fetched or the experiment has no results, an error is logged.
     """
-
-    ab_test_results_data = fetch_data("ab_test_results")
-
-    if not ab_test_results_data.empty:
-        max_experiment_id = ab_test_results_data['experiment_id'].max()
-        max_experiment_data = ab_test_results_data[ab_test_results_data['experiment_id'] == max_experiment_id]
-        return max_experiment_data
-    else:
-        st.error("No data fetched or empty dataset.")
-        return pd.DataFrame()
+    try:
+        response = get_api_session().get(f"{API_URL}/experiments/latest/summary")
+        if response.status_code == 200:
+            return response.json()
+        st.error(f"Failed to fetch the latest experiment results: {response.status_code}")
+    except Exception as e:
+        st.error(f"Error fetching the latest experiment results: {e}")
+    return {}
 
 def add_customer_to_backend(name, email, location, sub_id):
     """
@@ -112,47 +199,23 @@ def add_customer_to_backend(name, email, location, sub_id):
         "location": location,  
         "subscription_id": sub_id
     }
-    response = requests.post(f"{API_URL}/customers/", json=payload)
+    response = get_api_session().post(f"{API_URL}/customers/", json=payload)
     return response
 
-def get_barchart_data(data, ab_test_ids):
+def get_barchart_data(variant):
     """
-    Generates bar chart data based on A/B test results for each test ID.
+    Generates bar chart data from the results summary of one A/B test variant.
 
     **Parameters:**
-    - `data (pd.DataFrame)`: The data containing A/B test results.
-    - `ab_test_ids (list)`: A list of A/B test IDs to filter the data by.
+    - `variant (dict)`: One entry of the summary's `variants`, with `exposures` and `clicks`.
 
     **Returns:**
     - `pd.DataFrame`: The data formatted for a bar chart.
-    - `list`: List of customer IDs for each A/B test.
-
-    **Raises:**
-    - `KeyError`: If the specified columns or values are missing in the data, it may raise an error.
     """
-    bar_chart_data = []
-    customer_ids = []
-
-    for ab_test_id in ab_test_ids:
-        filtered = data[data['ab_test_id'] == ab_test_id]
-        counts = filtered['clicked_link'].value_counts()
-        
-        true_count = counts.get(True, 0)  # Access counts directly by key 'True'
-        false_count = counts.get(False, 0)  # Access counts directly by key 'False'
-
-        bar_chart_data.append({
-            "Clicked Link": "True",
-            "Frequency": true_count
-        })
-        bar_chart_data.append({
-            "Clicked Link": "False",
-            "Frequency": false_count
-        })
-
-        # Collect customer IDs for the current ab_test_id
-        customer_ids.append(filtered['customer_id'].unique())
-
-    return pd.DataFrame(bar_chart_data), customer_ids
+    return pd.DataFrame([
+        {"Clicked Link": "True", "Frequency": variant["clicks"]},
+        {"Clicked Link": "False", "Frequency": variant["exposures"] - variant["clicks"]},
+    ])
 
 def send_emails(segment_name, text_skeleton_1, text_skeleton_2, ab_test_id_a, ab_test_id_b):
     """
@@ -171,7 +234,7 @@ def send_emails(segment_name, text_skeleton_1, text_skeleton_2, ab_test_id_a, ab
     **Raises:**
     - `requests.exceptions.RequestException`: If there's an issue with the request, it raises an exception.
     """
-    response = requests.post(
+    response = get_api_session().post(
         f"{API_URL}/send-emails",
         json={
             "segment_name": segment_name,
@@ -215,11 +278,14 @@ if page == "General":
 elif page == "Dashboard":
     st.title("Welcome to the Dashboard!")
     col1, col2 = st.columns(2)
+    segments_data, segment_stats = fetch_data_concurrently(
+        ("segments", None, None),
+        ("segments/stats", None, None),
+    )
 
     # Placeholder 1: Segments Table
     with col1:
         st.subheader("Customer Segments")
-        segments_data = fetch_data("segments")
         if not segments_data.empty:
             st.table(segments_data.rename(columns={
                 "segment_id": "Segment ID", 
@@ -232,24 +298,8 @@ elif page == "Dashboard":
     # Placeholder 2: Frequency Chart for Customer Segments
     with col2:
         st.subheader("Segment Frequency Chart")
-        customer_segments_data = fetch_data("customer_segments")
-        if not customer_segments_data.empty:
-            frequency = customer_segments_data["segment_id"].value_counts().reset_index()
-            frequency.columns = ["Segment ID", "Frequency"]
-            
-            # Merge with segment names for better labeling
-            if not segments_data.empty:
-                frequency = frequency.merge(
-                    segments_data[["segment_id", "segment_name"]],
-                    left_on="Segment ID",
-                    right_on="segment_id",
-                    how="left"
-                )
-                frequency["Segment Name"] = frequency["segment_name"]
-                frequency = frequency[["Segment Name", "Frequency"]]
-            else:
-                frequency["Segment Name"] = frequency["Segment ID"]
-
+        if not segment_stats.empty:
+            frequency = segment_stats.rename(columns={"segment_name": "Segment Name", "customers": "Frequency"})
             st.bar_chart(frequency.set_index("Segment Name")["Frequency"])
         else:
             st.write("No customer segment data available.")
@@ -331,7 +381,8 @@ if page == "Start A/B Testing":
                     ab_tests_data["ab_test_id"][1]
                 )
                 if response.status_code == 200:
-                    st.success("Emails sent successfully! Click Again")
+                    st.session_state.campaign_job_id = response.json()["job_id"]
+                    st.success(f"Campaign queued as job {st.session_state.campaign_job_id}! Click Again")
                     st.session_state.ab_step = "results_ready"
                 else:
                     st.error(f"Failed to send emails: {response.json()['detail']}")
@@ -351,11 +402,11 @@ if page == "Start A/B Testing":
 
         context_value = None
         if engagement_strategy == "by genre":
-            genres_data = fetch_data("movies", filters={"type": "movie_genre"})
+            genres_data = fetch_data("movies", fields="movie_genre")
             if not genres_data.empty:
                 context_value = st.selectbox("Select a genre:", genres_data["movie_genre"].unique())
         elif engagement_strategy == "by movie":
-            movies_data = fetch_data("movies", filters={"type": "movie_name"})
+            movies_data = fetch_data("movies", fields="movie_name")
             if not movies_data.empty:
                 context_value = st.selectbox("Select a movie:", movies_data["movie_name"].unique())
 
@@ -372,24 +423,17 @@ if page == "Start A/B Testing":
                 st.session_state.results_ready = True
                 st.session_state.results = results.tolist()
 
-                if engagement_strategy == 'by genre':
-                    response = send_emails(
-                        st.session_state.selected_segment,
-                        st.session_state.results[0],
-                        st.session_state.results[1],
-                        ab_tests_data["ab_test_id"][4],
-                        ab_tests_data["ab_test_id"][5]
-                    )
-                if engagement_strategy == 'by movie':
-                    response = send_emails(
-                        st.session_state.selected_segment,
-                        st.session_state.results[0],
-                        st.session_state.results[1],
-                        ab_tests_data["ab_test_id"][2],
-                        ab_tests_data["ab_test_id"][3]
-                    )
+                # The API returns only the two variants of the chosen strategy
+                response = send_emails(
+                    st.session_state.selected_segment,
+                    st.session_state.results[0],
+                    st.session_state.results[1],
+                    ab_tests_data["ab_test_id"][0],
+                    ab_tests_data["ab_test_id"][1]
+                )
                 if response.status_code == 200:
-                    st.success("Emails sent successfully! Click Again")
+                    st.session_state.campaign_job_id = response.json()["job_id"]
+                    st.success(f"Campaign queued as job {st.session_state.campaign_job_id}! Click Again")
                     st.session_state.ab_step = "results_ready"
                 else:
                     st.error(f"Failed to send emails: {response.json()['detail']}")
@@ -412,6 +456,23 @@ if page == "Start A/B Testing":
         else:
             st.write("No results available.")
 
+        if "campaign_job_id" in st.session_state:
+            try:
+                response = get_api_session().get(f"{API_URL}/campaigns/{st.session_state.campaign_job_id}")
+                if not response.ok:
+                    st.error(f"Failed to fetch the campaign progress: {response.status_code}")
+                else:
+                    job = response.json()
+                    if job["status"] == "failed":
+                        st.error(f"Campaign failed: {job['error']}")
+                    else:
+                        st.progress(job["progress"] or 0.0)
+                        st.write(f"Campaign {job['status']}: {job['sent']} sent, {job['failed']} failed.")
+            except Exception as e:
+                st.error(f"Error fetching the campaign progress: {e}")
+            if st.button("Refresh progress"):
+                st.experimental_rerun()
+
         st.subheader("You will see the results shortly")
         if st.button("View the results"):
             st.session_state.ab_step = "view_results"
@@ -420,16 +481,17 @@ if page == "Start A/B Testing":
         st.title("A/B Testing Results")
         st.subheader("Graphical Results")
 
-        filtered_data = get_max_experiment_id_data()
-        st.write(filtered_data)
+        summary = get_max_experiment_id_data()
+        variants = summary.get("variants", [])
+        if variants:
+            st.write(pd.DataFrame(variants))
 
-        ab_test_idx = filtered_data["ab_test_id"].unique()
         col1, col2 = st.columns(2)
 
         with col1:
             st.write(f"**Test Version A**")
-            if len(ab_test_idx) > 0:
-                bar_chart_data_1, customer_ids_1 = get_barchart_data(filtered_data, [ab_test_idx[0]])  # Pass as a list
+            if len(variants) > 0:
+                bar_chart_data_1 = get_barchart_data(variants[0])
                 st.bar_chart(bar_chart_data_1.set_index("Clicked Link"))
 
             else:
@@ -437,8 +499,8 @@ if page == "Start A/B Testing":
 
         with col2:
             st.write(f"**Test Version B**")
-            if len(ab_test_idx) > 1:
-                bar_chart_data_2, customer_ids_2 = get_barchart_data(filtered_data, [ab_test_idx[1]])  # Pass as a list
+            if len(variants) > 1:
+                bar_chart_data_2 = get_barchart_data(variants[1])
                 st.bar_chart(bar_chart_data_2.set_index("Clicked Link"))
                 
             else:
@@ -446,11 +508,8 @@ if page == "Start A/B Testing":
 
 
         st.subheader("Results")
-        experiment_id = filtered_data["experiment_id"].unique()
-        experiments_table = fetch_data("experiments")
-        experiments_table = experiments_table[experiments_table["experiment_id"] == int(experiment_id)]
-        p_value = experiments_table["p_value"]
-        st.write(f"P value for this A/B test is {float(p_value)}")
+        if summary.get("p_value") is not None:
+            st.write(f"P value for this A/B test is {float(summary['p_value'])}")
 
         if st.button("Refresh and Start Again"):
             reset_app()
@@ -0,0 +1,121 @@
+"""
+Deterministic assignment of customers to A/B test variants.
+
+Customers are assigned one at a time while the target segment is streamed, so no list of the
+whole segment is ever needed:
+
+- Without stratification, a customer's variant depends only on a hash of
+  `(experiment_id, customer_id)`, so it is independent of query order and can be recomputed later.
+- With stratification, each stratum (e.g. a subscription or a location) is filled with permuted
+  blocks of `sum(weights)` customers, so every stratum matches the weights up to one block.
+  Weights are divided by their greatest common divisor and capped at `MAX_WEIGHT`, which keeps
+  the block small.
+  The permutation of each block is seeded by a hash of `(experiment_id, stratum, block)`, so the
+  assignment is reproducible for the same stream order.
+"""
+
+import hashlib
+import random
+from functools import reduce
+from math import gcd
+from typing import Hashable, Optional, Sequence
+
+# Largest relative weight of a variant; bounds the size of a stratified block
+MAX_WEIGHT = 1000
+
+
+def assignment_hash(*key) -> int:
+    """
+    Hash a key to a stable 64-bit integer (unlike `hash()`, identical across processes).
+
+    **Parameters:**
+    - `*key`: The values making up the key, e.g. an experiment and a customer ID.
+
+    **Returns:**
+    - `value (int)`: An integer in `[0, 2**64)`.
+    """
+    digest = hashlib.sha256(":".join(str(part) for part in key).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class VariantAssigner:
+    """
+    Assign customers of one experiment to weighted variants.
+
+    **Attributes:**
+    - `experiment_id (int)`: The experiment the assignment belongs to.
+    - `variants (list)`: The variants to assign, e.g. A/B test IDs.
+    - `weights (list[int])`: Relative weight of each variant.
+    - `stratified (bool)`: Whether to balance the variants within each stratum.
+    """
+
+    def __init__(
+        self,
+        experiment_id: int,
+        variants: Sequence[Hashable],
+        weights: Optional[Sequence[int]] = None,
+        stratified: bool = False,
+    ):
+        """
+        **Parameters:**
+        - `experiment_id (int)`: The experiment the assignment belongs to.
+        - `variants (Sequence)`: The variants to assign, at least two.
+        - `weights (Sequence[int], optional)`: Relative weights from 1 to `MAX_WEIGHT`, one per variant (default is equal weights).
+        - `stratified (bool, optional)`: Whether to balance the variants within each stratum (default is False).
+
+        **Raises:**
+        - `ValueError`: If there are fewer than two variants, the weights do not match them or a weight exceeds `MAX_WEIGHT`.
+        """
+        weights = list(weights) if weights is not None else [1] * len(variants)
+        if len(variants) < 2:
+            raise ValueError("At least two variants are required.")
+        if len(weights) != len(variants) or any(weight <= 0 for weight in weights):
+            raise ValueError("Weights must be positive and given for every variant.")
+        if any(weight > MAX_WEIGHT for weight in weights):
+            raise ValueError(f"Weights must not exceed {MAX_WEIGHT}.")
+
+        self.experiment_id = experiment_id
+        self.variants = list(variants)
+        self.weights = weights
+        self.stratified = stratified
+
+        # Only the ratios matter, so the smallest equivalent weights give the smallest block
+        divisor = reduce(gcd, weights)
+        reduced = [weight // divisor for weight in weights]
+
+        self._cumulative = []
+        total = 0
+        for weight in reduced:
+            total += weight
+            self._cumulative.append(total)
+        self._block = None
+        if stratified:
+            self._block = [variant for variant, weight in zip(self.variants, reduced) for _ in range(weight)]
+        self._strata = {}  # stratum -> [customers seen, current shuffled block]
+
+    def assign(self, customer_id: int, stratum: Optional[Hashable] = None):
+        """
+        Assign one customer to a variant in O(1).
+
+        **Parameters:**
+        - `customer_id (int)`: The customer to assign.
+        - `stratum (Hashable, optional)`: The customer's stratum; ignored unless `stratified` is set.
+
+        **Returns:**
+        - `variant`: One of `variants`.
+        """
+        if not self.stratified:
+            point = assignment_hash(self.experiment_id, customer_id) % self._cumulative[-1]
+            for variant, bound in zip(self.variants, self._cumulative):
+                if point < bound:
+                    return variant
+
+        state = self._strata.setdefault(stratum, [0, None])
+        seen, block = state
+        position = seen % len(self._block)
+        if position == 0:
+            block = list(self._block)
+            random.Random(assignment_hash(self.experiment_id, stratum, seen // len(self._block))).shuffle(block)
+            state[1] = block
+        state[0] = seen + 1
+        return block[position]
@@ -0,0 +1,402 @@
+"""
+Background processing of email campaigns.
+
+`/send-emails` only queues a `CampaignJob` row; this module claims queued jobs and sends them.
+Run it as its own process next to the API:
+
+    python campaigns.py
+"""
+
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from loguru import logger
+from sqlalchemy import func, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+import models1 as models1
+from assignment import VariantAssigner
+from counters import increment_ab_test_counter
+from database1 import SessionLocal
+from email_utils import dispatch_emails, generate_click_token, smtp_pool
+
+CAMPAIGN_POLL_INTERVAL = 2.0  # Seconds the worker sleeps when the queue is empty
+CAMPAIGN_PROGRESS_INTERVAL = 1.0  # Seconds between progress writes while a job is sending
+CAMPAIGN_HEARTBEAT_INTERVAL = 10.0  # Seconds between heartbeats of a running job
+CAMPAIGN_STALE_AFTER = 60.0  # Seconds without a heartbeat after which a running job is requeued
+ASSIGNMENT_BATCH_SIZE = 10_000  # Customers streamed per round trip and ab_test_results rows written per batch
+
+# Customer attributes campaigns can be stratified by
+STRATIFY_COLUMNS = {
+    "subscription": models1.Customer.subscription_id,
+    "location": models1.Customer.location,
+}
+
+
+def save_pool_stats(db: Session):
+    """
+    Write the throughput of this worker's SMTP connections to `email_pool_stats`, in the caller's transaction.
+
+    The pool lives in the worker process, so this is how the API can report it.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    """
+    stats = smtp_pool.stats()
+    if not stats:
+        return
+    table = models1.EmailPoolStats.__table__
+    updated_at = datetime.now(timezone.utc)
+    statement = pg_insert(table).values([{**connection, "updated_at": updated_at} for connection in stats])
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.connection_id],
+        set_={column: statement.excluded[column] for column in stats[0] if column != "connection_id"}
+        | {"updated_at": statement.excluded.updated_at},
+    )
+    db.execute(statement)
+
+
+def requeue_stale_jobs(db: Session) -> int:
+    """
+    Put running jobs whose worker stopped sending heartbeats back in the queue.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+
+    **Returns:**
+    - `requeued (int)`: Number of jobs requeued.
+    """
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=CAMPAIGN_STALE_AFTER)
+    requeued = (
+        db.query(models1.CampaignJob)
+        .filter(
+            models1.CampaignJob.status == "running",
+            func.coalesce(models1.CampaignJob.heartbeat_at, models1.CampaignJob.started_at) < stale_before,
+        )
+        .update({"status": "queued"}, synchronize_session=False)
+    )
+    db.commit()
+    if requeued:
+        logger.warning(f"Requeued {requeued} campaign jobs without a heartbeat for {CAMPAIGN_STALE_AFTER:.0f}s.")
+    return requeued
+
+
+def claim_next_job(db: Session):
+    """
+    Atomically take the oldest queued campaign job and mark it as running.
+
+    Stale running jobs are requeued first. `FOR UPDATE SKIP LOCKED` lets several workers poll the
+    same table without claiming a job twice.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+
+    **Returns:**
+    - `job (models1.CampaignJob)`: The claimed job, or `None` if the queue is empty.
+    """
+    requeue_stale_jobs(db)
+    job = (
+        db.query(models1.CampaignJob)
+        .filter(models1.CampaignJob.status == "queued")
+        .order_by(models1.CampaignJob.job_id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        db.rollback()
+        return None
+
+    job.status = "running"
+    job.heartbeat_at = datetime.now(timezone.utc)
+    if job.started_at is None:
+        job.started_at = job.heartbeat_at
+    db.commit()
+    return job
+
+
+class JobHeartbeat:
+    """
+    Refresh a running job's `heartbeat_at` from a background thread, so other workers can tell it is alive,
+    and report the SMTP pool's throughput with every beat.
+
+    Used as a context manager around the work on the job.
+
+    **Attributes:**
+    - `job_id (int)`: The running job.
+    - `interval (float)`: Seconds between heartbeats.
+    """
+
+    def __init__(self, job_id: int, interval: float = CAMPAIGN_HEARTBEAT_INTERVAL):
+        self.job_id = job_id
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"campaign-heartbeat-{self.job_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                with SessionLocal() as db:
+                    db.query(models1.CampaignJob).filter(models1.CampaignJob.job_id == self.job_id).update(
+                        {"heartbeat_at": datetime.now(timezone.utc)}, synchronize_session=False
+                    )
+                    save_pool_stats(db)
+                    db.commit()
+            except Exception as e:
+                logger.warning(f"Heartbeat of campaign job {self.job_id} failed: {e}")
+
+
+def target_customers_query(db: Session, segment_name: str, stratify_by: str = None):
+    """
+    Build the query for the `customer_id`, `name` and `email` of every customer in a segment.
+
+    Only these columns are selected, so the rows can be streamed with `yield_per` instead of
+    loading full `Customer` entities.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `segment_name (str)`: The name of the customer segment (case-insensitive).
+    - `stratify_by (str, optional)`: A key of `STRATIFY_COLUMNS` to also select, as `stratum`.
+
+    **Returns:**
+    - `query (Query)`: The projected query, not yet executed.
+    """
+    columns = [models1.Customer.customer_id, models1.Customer.name, models1.Customer.email]
+    if stratify_by is not None:
+        columns.append(STRATIFY_COLUMNS[stratify_by].label("stratum"))
+    return (
+        db.query(*columns)
+        .join(models1.CustomerSegment, models1.Customer.customer_id == models1.CustomerSegment.customer_id)
+        .join(models1.Segment, models1.CustomerSegment.segment_id == models1.Segment.segment_id)
+        .filter(
+            models1.Segment.segment_name.ilike(segment_name),
+            models1.Customer.customer_id > 2000
+        )
+    )
+
+
+def assign_customers(db: Session, job, variants) -> int:
+    """
+    Create the experiment for a campaign job and assign every targeted customer to a variant.
+
+    The assignments and exposure counters are committed in one transaction together with the job's
+    `experiment_id` and `total`, so a requeued job either finds them all or starts over.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `job (models1.CampaignJob)`: The running job.
+    - `variants (list[dict])`: The job's variants, with `ab_test_id` and `weight`.
+
+    **Returns:**
+    - `experiment_id (int)`: The ID of the new experiment.
+
+    **Raises:**
+    - `ValueError`: If no customers are found for the job's segment.
+    """
+    # Insert a new experiment row with a placeholder p-value of 1 (not significant), which the A/B
+    # testing job replaces; `p_value` is not optional in the `/experiments/` response schema
+    new_experiment = models1.Experiment(p_value=float(1))
+    db.add(new_experiment)
+    db.commit()
+    db.refresh(new_experiment)
+    experiment_id = new_experiment.experiment_id  # Retrieve the generated experiment ID
+
+    # Count, then stream, only the columns the campaign needs
+    target_customers = target_customers_query(db, job.segment_name, job.stratify_by)
+    total = target_customers.count()
+    if not total:
+        raise ValueError(f"No customers found for the segment '{job.segment_name}'.")
+
+    # Assign each customer to a variant as it streams by, inserting click tracking data into
+    # ab_test_results one batch at a time, without ORM objects
+    assigner = VariantAssigner(
+        experiment_id,
+        [variant["ab_test_id"] for variant in variants],
+        [variant["weight"] for variant in variants],
+        stratified=job.stratify_by is not None,
+    )
+    exposures = {variant["ab_test_id"]: 0 for variant in variants}
+    batch = []
+    # Ordered, so stratified block assignment is reproducible
+    for customer in target_customers.order_by(models1.Customer.customer_id).yield_per(ASSIGNMENT_BATCH_SIZE):
+        stratum = customer.stratum if job.stratify_by is not None else None
+        ab_test_id = assigner.assign(customer.customer_id, stratum)
+        exposures[ab_test_id] += 1
+        batch.append({
+            "ab_test_id": ab_test_id,
+            "experiment_id": experiment_id,
+            "customer_id": customer.customer_id,
+            "clicked_link": False,  # Default to False; updated upon click
+        })
+        if len(batch) == ASSIGNMENT_BATCH_SIZE:
+            db.execute(insert(models1.ABTestResult), batch)
+            batch = []
+    if batch:
+        db.execute(insert(models1.ABTestResult), batch)
+
+    # Commit tracking data and exposure counters before mailing, so early clicks find their rows.
+    # The job row is only written here, so the heartbeat thread is not blocked by its lock meanwhile.
+    for ab_test_id, count in exposures.items():
+        increment_ab_test_counter(db, experiment_id, ab_test_id, exposures=count)
+    job.experiment_id = experiment_id
+    job.total = total
+    db.commit()
+    return experiment_id
+
+
+def run_campaign(db: Session, job):
+    """
+    Create the experiment for a campaign job, record its exposures and send its emails.
+
+    Emails are sent in `customer_id` order. Every `CAMPAIGN_PROGRESS_INTERVAL` seconds the job's
+    `sent` and `failed` counts are committed, so `/campaigns/{job_id}` can report progress while
+    the emails go out. The same commit stores `resume_after`: every customer up to that ID has been
+    processed. A requeued job skips the assignment and resumes after it. Emails that completed out
+    of order after that point, and emails sent after the last commit, may be sent twice.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `job (models1.CampaignJob)`: The running job.
+
+    **Raises:**
+    - `ValueError`: If no customers are found for the job's segment.
+    """
+    variants = job.variants or [
+        {"ab_test_id": job.ab_test_id_a, "text_skeleton": job.text_skeleton_1, "weight": 1},
+        {"ab_test_id": job.ab_test_id_b, "text_skeleton": job.text_skeleton_2, "weight": 1},
+    ]
+    if job.total is None:
+        experiment_id = assign_customers(db, job, variants)
+    else:
+        experiment_id = job.experiment_id
+        logger.info(f"Resuming campaign job {job.job_id} after customer {job.resume_after}.")
+
+    # Customers whose email was handed to the dispatcher, in order, and the outcomes that arrived
+    # for them; outcomes are counted once every earlier customer has one too
+    dispatched = deque()
+    outcomes = {}
+
+    def build_messages():
+        """Yield one email per assigned customer, streaming the assignments back from the database."""
+        skeletons = {variant["ab_test_id"]: variant["text_skeleton"] for variant in variants}
+        # A separate session, so the progress commits below do not close the server-side cursor
+        with SessionLocal() as stream_db:
+            assignments = (
+                stream_db.query(
+                    models1.ABTestResult.ab_test_id,
+                    models1.Customer.customer_id,
+                    models1.Customer.name,
+                    models1.Customer.email,
+                )
+                .join(models1.Customer, models1.ABTestResult.customer_id == models1.Customer.customer_id)
+                .filter(models1.ABTestResult.experiment_id == experiment_id)
+            )
+            if job.resume_after is not None:
+                assignments = assignments.filter(models1.ABTestResult.customer_id > job.resume_after)
+            assignments = assignments.order_by(models1.ABTestResult.customer_id).yield_per(ASSIGNMENT_BATCH_SIZE)
+            for ab_test_id, customer_id, name, email in assignments:
+                tracking_token = generate_click_token(ab_test_id, experiment_id, customer_id)
+                tracking_url = (
+                    f"http://localhost:8000/track/click/{ab_test_id}/{experiment_id}/{customer_id}/{tracking_token}"
+                )
+                first_name = name.split(" ")[0]
+                email_body = f"{skeletons[ab_test_id]}\n\nClick here to learn more: {tracking_url}"
+                dispatched.append(customer_id)
+                yield {
+                    "recipient_email": [email],
+                    "subject": "Exciting News",
+                    "body": f"Hi {first_name}!\n\n{email_body}",
+                    "customer_id": customer_id,
+                }
+
+    # Send the emails concurrently over the pooled SMTP sessions, committing progress periodically
+    last_progress = time.monotonic()
+
+    def record_result(message, error):
+        nonlocal last_progress
+        recipient = message["recipient_email"][0]
+        if error is None:
+            logger.info(f"Email sent successfully to {recipient}.")
+        else:
+            logger.warning(f"Failed to send email to {recipient}: {error}")
+        outcomes[message["customer_id"]] = error
+        while dispatched and dispatched[0] in outcomes:
+            customer_id = dispatched.popleft()
+            if outcomes.pop(customer_id) is None:
+                job.sent += 1
+            else:
+                job.failed += 1
+            job.resume_after = customer_id
+        if time.monotonic() - last_progress >= CAMPAIGN_PROGRESS_INTERVAL:
+            db.commit()
+            last_progress = time.monotonic()
+
+    dispatch_emails(build_messages(), on_result=record_result)
+
+
+def process_job(db: Session, job):
+    """
+    Run a claimed campaign job, with a heartbeat, and record its final status and the pool's throughput.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `job (models1.CampaignJob)`: The claimed job.
+    """
+    logger.info(f"Starting campaign job {job.job_id} for segment '{job.segment_name}'.")
+    try:
+        with JobHeartbeat(job.job_id):
+            run_campaign(db, job)
+        job.status = "completed"
+        logger.info(f"Campaign job {job.job_id} completed: {job.sent} sent, {job.failed} failed.")
+    except Exception as e:
+        db.rollback()
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"Campaign job {job.job_id} failed: {e}")
+    job.finished_at = datetime.now(timezone.utc)
+    save_pool_stats(db)
+    db.commit()
+
+
+def work(poll_interval: float = CAMPAIGN_POLL_INTERVAL):
+    """
+    Process queued campaign jobs one at a time, forever.
+
+    Errors, e.g. from a database that is unreachable or not set up yet, are logged and the worker
+    polls again after `poll_interval`; a job left running is requeued once its heartbeat is stale.
+
+    **Parameters:**
+    - `poll_interval (float, optional)`: Seconds to sleep when the queue is empty or after an error (default is `CAMPAIGN_POLL_INTERVAL`).
+    """
+    logger.info("Campaign worker started.")
+    while True:
+        idle = True
+        db = SessionLocal()
+        try:
+            job = claim_next_job(db)
+            if job is not None:
+                idle = False
+                process_job(db, job)
+        except Exception as e:
+            idle = True
+            logger.error(f"Campaign worker iteration failed: {e}")
+        finally:
+            db.close()
+        if idle:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    work()
@@ -0,0 +1,222 @@
+"""
+Click tracking for campaign emails.
+
+A click is recorded with one conditional `UPDATE ... RETURNING` on `ab_test_results`, served by
+the composite index on `(experiment_id, ab_test_id, customer_id)`. When `CLICK_BUFFER_ENABLED` is
+set, clicks are instead collected in memory and written in coalesced batches by `ClickBuffer`.
+Repeated clicks are dropped by `RecentClicks` before reaching the database.
+"""
+
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from counters import increment_ab_test_counter
+from database1 import SessionLocal
+
+CLICK_BUFFER_ENABLED = os.getenv("CLICK_BUFFER_ENABLED", "false").lower() == "true"
+CLICK_FLUSH_INTERVAL = 0.25  # Seconds between buffered click flushes
+RECENT_CLICKS_SIZE = 100_000  # Clicks remembered to reject duplicates without a query
+
+RECORD_CLICK_QUERY = text("""
+    UPDATE ab_test_results
+    SET clicked_link = TRUE
+    WHERE experiment_id = :experiment_id
+      AND ab_test_id = :ab_test_id
+      AND customer_id = :customer_id
+      AND clicked_link = FALSE
+    RETURNING result_id
+""")
+
+RECORD_CLICKS_QUERY = text("""
+    UPDATE ab_test_results AS r
+    SET clicked_link = TRUE
+    FROM unnest(
+        CAST(:experiment_ids AS integer[]),
+        CAST(:ab_test_ids AS integer[]),
+        CAST(:customer_ids AS integer[])
+    ) AS c(experiment_id, ab_test_id, customer_id)
+    WHERE r.experiment_id = c.experiment_id
+      AND r.ab_test_id = c.ab_test_id
+      AND r.customer_id = c.customer_id
+      AND r.clicked_link = FALSE
+    RETURNING r.experiment_id, r.ab_test_id
+""")
+
+
+def record_click(db: Session, ab_test_id: int, experiment_id: int, customer_id: int) -> bool:
+    """
+    Mark a customer's link as clicked and count the click, in the caller's transaction.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `ab_test_id (int)`: The ID of the A/B test variant.
+    - `experiment_id (int)`: The ID of the experiment.
+    - `customer_id (int)`: The ID of the customer.
+
+    **Returns:**
+    - `recorded (bool)`: `False` if there is no unclicked record for the customer.
+    """
+    updated = db.execute(
+        RECORD_CLICK_QUERY,
+        {"experiment_id": experiment_id, "ab_test_id": ab_test_id, "customer_id": customer_id},
+    ).first()
+    if updated is None:
+        return False
+    increment_ab_test_counter(db, experiment_id, ab_test_id, clicks=1)
+    return True
+
+
+def record_clicks(db: Session, clicks) -> int:
+    """
+    Mark many clicks at once and add them to the counters, in the caller's transaction.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `clicks (Iterable[tuple])`: Distinct `(ab_test_id, experiment_id, customer_id)` keys.
+
+    **Returns:**
+    - `recorded (int)`: Number of records newly marked as clicked.
+    """
+    clicks = list(clicks)
+    updated = db.execute(RECORD_CLICKS_QUERY, {
+        "ab_test_ids": [click[0] for click in clicks],
+        "experiment_ids": [click[1] for click in clicks],
+        "customer_ids": [click[2] for click in clicks],
+    }).all()
+    for (experiment_id, ab_test_id), count in Counter(tuple(row) for row in updated).items():
+        increment_ab_test_counter(db, experiment_id, ab_test_id, clicks=count)
+    return len(updated)
+
+
+class ClickBuffer:
+    """
+    Collect clicks in memory and flush them in coalesced batches from a background thread.
+
+    Repeated clicks on the same link between two flushes are written once.
+
+    **Attributes:**
+    - `flush_interval (float)`: Seconds between flushes.
+    """
+
+    def __init__(self, flush_interval: float = CLICK_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, ab_test_id: int, experiment_id: int, customer_id: int):
+        """
+        Queue a click for the next flush.
+
+        **Parameters:**
+        - `ab_test_id (int)`: The ID of the A/B test variant.
+        - `experiment_id (int)`: The ID of the experiment.
+        - `customer_id (int)`: The ID of the customer.
+        """
+        with self._lock:
+            self._pending.add((ab_test_id, experiment_id, customer_id))
+
+    def flush(self) -> int:
+        """
+        Write all queued clicks in one transaction.
+
+        **Returns:**
+        - `recorded (int)`: Number of records newly marked as clicked.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if not pending:
+            return 0
+
+        db = SessionLocal()
+        try:
+            recorded = record_clicks(db, pending)
+            db.commit()
+            return recorded
+        except Exception as e:
+            db.rollback()
+            with self._lock:
+                self._pending |= pending  # Retry on the next flush
+            logger.error(f"Failed to flush {len(pending)} buffered clicks: {e}")
+            return 0
+        finally:
+            db.close()
+
+    def start(self):
+        """
+        Start the background flushing thread.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="click-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and flush the remaining clicks.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+
+class RecentClicks:
+    """
+    Remember the most recently tracked clicks, to reject duplicates in memory.
+
+    **Attributes:**
+    - `maxsize (int)`: Number of clicks remembered; the least recently seen are forgotten first.
+    """
+
+    def __init__(self, maxsize: int = RECENT_CLICKS_SIZE):
+        self.maxsize = maxsize
+        self._clicks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, ab_test_id: int, experiment_id: int, customer_id: int) -> bool:
+        """
+        Check whether a click was already seen, and remember it.
+
+        **Parameters:**
+        - `ab_test_id (int)`: The ID of the A/B test variant.
+        - `experiment_id (int)`: The ID of the experiment.
+        - `customer_id (int)`: The ID of the customer.
+
+        **Returns:**
+        - `seen (bool)`: `True` if the click was seen before.
+        """
+        key = (ab_test_id, experiment_id, customer_id)
+        with self._lock:
+            if key in self._clicks:
+                self._clicks.move_to_end(key)
+                return True
+            self._clicks[key] = None
+            if len(self._clicks) > self.maxsize:
+                self._clicks.popitem(last=False)
+            return False
+
+    def forget(self, ab_test_id: int, experiment_id: int, customer_id: int):
+        """
+        Forget a click whose tracking failed, so it can be retried.
+
+        **Parameters:**
+        - `ab_test_id (int)`: The ID of the A/B test variant.
+        - `experiment_id (int)`: The ID of the experiment.
+        - `customer_id (int)`: The ID of the customer.
+        """
+        with self._lock:
+            self._clicks.pop((ab_test_id, experiment_id, customer_id), None)
+
+
+click_buffer = ClickBuffer()
+recent_clicks = RecentClicks()
@@ -0,0 +1,40 @@
+"""
+Running A/B test counters.
+
+`ab_test_counters` holds the exposures and clicks of every experiment variant, so results can be
+read without scanning `ab_test_results`. The campaign worker adds exposures when it assigns
+customers and click tracking adds clicks.
+"""
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+import models1 as models1
+
+
+def increment_ab_test_counter(db: Session, experiment_id: int, ab_test_id: int, exposures: int = 0, clicks: int = 0):
+    """
+    Add to the running exposure and click counters of an experiment variant.
+
+    The counter row is created on first use with a single `INSERT ... ON CONFLICT DO UPDATE`,
+    inside the caller's transaction.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `experiment_id (int)`: The ID of the experiment.
+    - `ab_test_id (int)`: The ID of the A/B test variant.
+    - `exposures (int, optional)`: Number of exposures to add (default is 0).
+    - `clicks (int, optional)`: Number of clicks to add (default is 0).
+    """
+    counter = models1.ABTestCounter.__table__
+    statement = pg_insert(counter).values(
+        experiment_id=experiment_id, ab_test_id=ab_test_id, exposures=exposures, clicks=clicks
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[counter.c.experiment_id, counter.c.ab_test_id],
+        set_={
+            "exposures": counter.c.exposures + statement.excluded.exposures,
+            "clicks": counter.c.clicks + statement.excluded.clicks,
+        },
+    )
+    db.execute(statement)
@@ -1,8 +1,14 @@
+import base64
+import hashlib
+import hmac
+import os
 import smtplib
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import List
-import uuid
+from typing import Callable, Dict, Iterable, List, Optional
 
 # Configuration variables (replace with your actual values)
 SMTP_SERVER = "smtp.gmail.com"
@@ -10,14 +16,255 @@ SMTP_PORT = 465
 SENDER_EMAIL = "ani.aloyan2003@gmail.com"  # Your Gmail address
 SENDER_PASSWORD = "roky gfog rwix fhjv"  # Your Gmail App Password (not regular password)
 
-def generate_click_token() -> str:
+# Connection pool settings
+SMTP_POOL_SIZE = 4  # Maximum number of authenticated SMTP sessions kept open
+SMTP_TIMEOUT = 30  # Socket timeout in seconds
+SMTP_IDLE_CHECK_SECONDS = 60  # Idle time after which a session is checked with NOOP before reuse
+
+# Concurrent dispatch settings
+EMAIL_DISPATCH_WORKERS = SMTP_POOL_SIZE  # Threads sending in parallel (one per pooled session)
+EMAIL_SEND_RETRIES = 2  # Extra attempts per recipient after a transient failure
+EMAIL_RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled on every further retry
+
+# Key used to sign click tracking links. There is no default: a key known from the source would let
+# anyone forge clicks, so the API and the campaign worker refuse to start without one.
+CLICK_TOKEN_SECRET = os.getenv("CLICK_TOKEN_SECRET")
+if not CLICK_TOKEN_SECRET:
+    raise RuntimeError("CLICK_TOKEN_SECRET is not set; it is required to sign click tracking links.")
+CLICK_TOKEN_SECRET = CLICK_TOKEN_SECRET.encode()
+
+
+class PooledSMTPConnection:
+    """
+    An authenticated SMTP session owned by `SMTPConnectionPool`, with its usage statistics.
+
+    **Attributes:**
+    - `connection_id (int)`: Identifier of the connection within its pool.
+    - `server (smtplib.SMTP_SSL)`: The logged-in SMTP session.
+    - `messages (int)`: Number of messages sent over this connection.
+    - `errors (int)`: Number of failed send attempts on this connection.
+    - `send_seconds (float)`: Total time spent sending messages.
+    - `opened_at (float)`: Time the session was opened.
+    - `last_used (float)`: Time the session was last used.
+    """
+
+    def __init__(self, connection_id: int, server: smtplib.SMTP_SSL):
+        self.connection_id = connection_id
+        self.server = server
+        self.messages = 0
+        self.errors = 0
+        self.send_seconds = 0.0
+        self.opened_at = time.time()
+        self.last_used = self.opened_at
+
+    def close(self):
+        """
+        Close the SMTP session, ignoring errors from an already broken connection.
+        """
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SMTPConnectionPool:
+    """
+    A thread-safe pool of authenticated SMTP sessions reused across messages.
+
+    Sessions are opened lazily up to `size`, so a campaign pays the TLS handshake and login once per
+    connection instead of once per email. A session that fails is reopened transparently and the
+    message is retried once on the new session. Callers wait on a condition variable that is notified
+    both when a session is returned and when a failed session frees its slot, so no waiter is left
+    blocked while a new session could be opened.
+
+    **Attributes:**
+    - `size (int)`: Maximum number of open sessions.
     """
-    Generate a unique token for click tracking.
+
+    def __init__(
+        self,
+        size: int = SMTP_POOL_SIZE,
+        host: str = SMTP_SERVER,
+        port: int = SMTP_PORT,
+        username: str = SENDER_EMAIL,
+        password: str = SENDER_PASSWORD,
+        timeout: float = SMTP_TIMEOUT,
+    ):
+        self.size = size
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: List[PooledSMTPConnection] = []  # Returned sessions, reused most recent first
+        self._free_ids = list(range(size - 1, -1, -1))  # Slots without an open session
+        self._connections: Dict[int, PooledSMTPConnection] = {}
+
+    def _open(self, connection_id: int) -> PooledSMTPConnection:
+        server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        server.login(self.username, self.password)
+        connection = PooledSMTPConnection(connection_id, server)
+        with self._lock:
+            previous = self._connections.get(connection_id)
+            if previous is not None:
+                # Keep the throughput history of the slot across reconnects
+                connection.messages = previous.messages
+                connection.errors = previous.errors
+                connection.send_seconds = previous.send_seconds
+            self._connections[connection_id] = connection
+        return connection
+
+    def _acquire(self) -> PooledSMTPConnection:
+        with self._available:
+            # Wake up for either a returned session or a freed slot
+            self._available.wait_for(lambda: self._idle or self._free_ids)
+            connection = self._idle.pop() if self._idle else None
+            connection_id = None if connection is not None else self._free_ids.pop()
+        if connection is None:
+            try:
+                return self._open(connection_id)
+            except Exception:
+                self._free_slot(connection_id)
+                raise
+
+        # Servers drop idle sessions; check long-idle ones before reuse
+        if time.time() - connection.last_used > SMTP_IDLE_CHECK_SECONDS:
+            try:
+                status, _ = connection.server.noop()
+                if status != 250:
+                    raise smtplib.SMTPServerDisconnected(f"NOOP returned {status}")
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+                connection = self._reconnect(connection)
+        return connection
+
+    def _reconnect(self, connection: PooledSMTPConnection) -> PooledSMTPConnection:
+        try:
+            return self._open(connection.connection_id)
+        except Exception:
+            self._free_slot(connection.connection_id)
+            raise
+
+    def _release(self, connection: PooledSMTPConnection):
+        with self._available:
+            self._idle.append(connection)
+            self._available.notify()
+
+    def _free_slot(self, connection_id: int):
+        with self._available:
+            self._free_ids.append(connection_id)
+            self._available.notify()
+
+    def send(self, sender: str, recipients: List[str], message: str):
+        """
+        Send a message over a pooled session, reconnecting and retrying once if the session broke.
+
+        **Parameters:**
+        - `sender (str)`: The envelope sender address.
+        - `recipients (List[str])`: The recipient addresses.
+        - `message (str)`: The full message, including headers.
+
+        **Raises:**
+        - `smtplib.SMTPException`: If the message cannot be sent on a fresh session either.
+        """
+        connection = self._acquire()
+        for attempt in range(2):
+            started = time.perf_counter()
+            try:
+                connection.server.sendmail(sender, recipients, message)
+            except Exception as e:
+                connection.errors += 1
+                # SMTPException subclasses OSError: only disconnects and socket errors break the session
+                session_broken = isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)) or (
+                    isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+                )
+                if not session_broken:
+                    # The session is still usable (e.g. a refused recipient)
+                    connection.last_used = time.time()
+                    self._release(connection)
+                    raise
+                connection.close()
+                if attempt == 1:
+                    self._free_slot(connection.connection_id)
+                    raise
+                connection = self._reconnect(connection)
+                continue
+
+            connection.messages += 1
+            connection.send_seconds += time.perf_counter() - started
+            connection.last_used = time.time()
+            self._release(connection)
+            return
+
+    def stats(self) -> List[dict]:
+        """
+        Report per-connection throughput.
+
+        **Returns:**
+        - `stats (List[dict])`: For every connection, its ID, message and error counts, time spent
+          sending and messages per second of sending time.
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+        return [
+            {
+                "connection_id": connection.connection_id,
+                "messages": connection.messages,
+                "errors": connection.errors,
+                "send_seconds": round(connection.send_seconds, 3),
+                "messages_per_second": round(connection.messages / connection.send_seconds, 2)
+                if connection.send_seconds else 0.0,
+            }
+            for connection in sorted(connections, key=lambda connection: connection.connection_id)
+        ]
+
+    def close(self):
+        """
+        Close every idle session in the pool.
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+            self._free_slot(connection.connection_id)
+
+
+# Shared pool used by `send_email`
+smtp_pool = SMTPConnectionPool()
+
+def generate_click_token(ab_test_id: int, experiment_id: int, customer_id: int) -> str:
+    """
+    Sign a click tracking link, so it can be verified without a database lookup.
+
+    **Parameters:**
+    - `ab_test_id (int)`: The ID of the A/B test variant.
+    - `experiment_id (int)`: The ID of the experiment.
+    - `customer_id (int)`: The ID of the customer.
 
     **Returns:**
-    - `click_token (str)`: A randomly generated UUID token for tracking clicks.
+    - `click_token (str)`: A URL-safe, 128-bit HMAC-SHA256 of the three IDs.
     """
-    return str(uuid.uuid4())
+    message = f"{ab_test_id}:{experiment_id}:{customer_id}".encode()
+    digest = hmac.new(CLICK_TOKEN_SECRET, message, hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+def verify_click_token(click_token: str, ab_test_id: int, experiment_id: int, customer_id: int) -> bool:
+    """
+    Check that a click token was issued for these IDs, in constant time.
+
+    **Parameters:**
+    - `click_token (str)`: The token from the tracking link.
+    - `ab_test_id (int)`: The ID of the A/B test variant.
+    - `experiment_id (int)`: The ID of the experiment.
+    - `customer_id (int)`: The ID of the customer.
+
+    **Returns:**
+    - `valid (bool)`: Whether the token matches.
+    """
+    expected = generate_click_token(ab_test_id, experiment_id, customer_id)
+    return hmac.compare_digest(expected, click_token)
 
 def send_email(
     recipient_email: List[str],
@@ -33,7 +280,7 @@ def send_email(
     - `body (str)`: The body of the email, including the tracking link.
 
     **Behavior:**
-    - Sends an email using the SMTP server.
+    - Sends an email over a pooled, already authenticated SMTP session (see `SMTPConnectionPool`).
 
     **Raises:**
     - `smtplib.SMTPException`: If there is an error sending the email.
@@ -48,12 +295,98 @@ def send_email(
         # Add the email body
         msg.attach(MIMEText(body, 'html'))
 
-        # Using Gmail's SMTP server with SSL (Port 465)
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)  # Use App Password here
-            server.sendmail(SENDER_EMAIL, recipient_email, msg.as_string())  # Send the email
-            print(f"Email sent to {', '.join(recipient_email)}")
+        # Using Gmail's SMTP server with SSL (Port 465), reusing pooled sessions
+        smtp_pool.send(SENDER_EMAIL, recipient_email, msg.as_string())
+        print(f"Email sent to {', '.join(recipient_email)}")
     
     except smtplib.SMTPException as e:
         print(f"Error sending email to {', '.join(recipient_email)}: {e}")
         raise
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Decide whether a failed send is worth retrying.
+
+    Network errors, dropped sessions and 4xx replies are transient. 5xx replies, such as a refused
+    recipient or a rejected login, fail the same way on every attempt.
+
+    **Parameters:**
+    - `error (Exception)`: The error raised by `send_email`.
+
+    **Returns:**
+    - `transient (bool)`: `True` if the send may succeed when retried.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    # SMTPException subclasses OSError: any other SMTP error is a client-side problem
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def send_email_with_retry(message: dict, retries: int = EMAIL_SEND_RETRIES, backoff: float = EMAIL_RETRY_BACKOFF):
+    """
+    Send one email, retrying transient SMTP or network errors with exponential backoff.
+
+    **Parameters:**
+    - `message (dict)`: The `recipient_email`, `subject` and `body` arguments of `send_email`.
+    - `retries (int, optional)`: Extra attempts after the first failure (default is `EMAIL_SEND_RETRIES`).
+    - `backoff (float, optional)`: Seconds before the first retry (default is `EMAIL_RETRY_BACKOFF`).
+
+    **Raises:**
+    - `smtplib.SMTPException`: If the error is permanent or the last attempt fails.
+    """
+    for attempt in range(retries + 1):
+        try:
+            send_email(message["recipient_email"], message["subject"], message["body"])
+            return
+        except OSError as e:  # Includes smtplib.SMTPException
+            if attempt == retries or not is_transient_error(e):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def dispatch_emails(
+    messages: Iterable[dict],
+    max_workers: int = EMAIL_DISPATCH_WORKERS,
+    retries: int = EMAIL_SEND_RETRIES,
+    on_result: Optional[Callable[[dict, Optional[Exception]], None]] = None,
+) -> dict:
+    """
+    Send many emails concurrently on a bounded thread pool.
+
+    At most `2 * max_workers` messages are in flight at once, so `messages` can be a lazy
+    iterator over a very large campaign without being materialized.
+
+    **Parameters:**
+    - `messages (Iterable[dict])`: Messages with `recipient_email`, `subject` and `body` keys; extra keys are passed through to `on_result`.
+    - `max_workers (int, optional)`: Number of sending threads (default is `EMAIL_DISPATCH_WORKERS`).
+    - `retries (int, optional)`: Extra attempts per recipient (default is `EMAIL_SEND_RETRIES`).
+    - `on_result (Callable, optional)`: Called with each message and `None` on success or the final exception on failure.
+
+    **Returns:**
+    - `summary (dict)`: The number of `sent` and `failed` messages.
+    """
+    summary = {"sent": 0, "failed": 0}
+
+    def collect(futures):
+        for future in futures:
+            message = in_flight.pop(future)
+            error = future.exception()
+            summary["failed" if error else "sent"] += 1
+            if on_result is not None:
+                on_result(message, error)
+
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for message in messages:
+            if len(in_flight) >= 2 * max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(send_email_with_retry, message, retries)] = message
+        done, _ = wait(in_flight)
+        collect(done)
+    return summary
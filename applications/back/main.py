@@ -1,21 +1,44 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, text
 from sqlalchemy.orm import Session
 from database1 import engine, SessionLocal
 import models1 as models1,schema1 as schemas
-from email_utils import send_email 
+from email_utils import send_email, verify_click_token
+from assignment import MAX_WEIGHT
+from campaigns import STRATIFY_COLUMNS
+from clicks import CLICK_BUFFER_ENABLED, click_buffer, recent_clicks, record_click
+from response_cache import response_cache
+from segment_counts import segment_counts_refresher
 from datetime import datetime, timezone
+from typing import List, Literal, NamedTuple, Optional
+from pydantic import TypeAdapter, ValidationError
+import json
+import operator
 import pandas as pd
 import requests
 from loguru import logger
-import uuid
 
-# Creating database tables
+# Creating database tables, indexes added to tables that already exist (dropping the ones they
+# supersede), and the segment counts view
 models1.Base.metadata.create_all(bind=engine)
+for table in models1.Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+with engine.begin() as connection:
+    for index_name in models1.SUPERSEDED_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+# Columns added to campaign_jobs after the table was first created
+with engine.begin() as connection:
+    connection.execute(text("ALTER TABLE campaign_jobs ADD COLUMN IF NOT EXISTS resume_after INTEGER"))
+    connection.execute(text("ALTER TABLE campaign_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP"))
+models1.create_segment_counts_view(engine)
 
 app = FastAPI()
 
 @app.get("/test-send-email")
-async def test_send_email():
+def test_send_email():
     """
     Send a test email.
 
@@ -38,7 +61,6 @@ async def test_send_email():
     return {"message": "Test email sent successfully!"}
 
 
-
 import logging
 
 # Set up logging configuration
@@ -67,6 +89,273 @@ def get_db():
         db.close()
 
 
+@app.get("/email-pool/stats")
+def read_email_pool_stats(db: Session = Depends(get_db)):
+    """
+    Report the throughput of each pooled SMTP connection of the campaign worker.
+
+    The campaign emails are sent by the worker process, which writes its pool's statistics to
+    `email_pool_stats` with every heartbeat and when a job finishes.
+
+    **Returns:**
+    - `connections (list)`: Per-connection message and error counts, time spent sending, messages per second
+      and when the worker last reported them.
+    """
+    connections = db.query(models1.EmailPoolStats).order_by(models1.EmailPoolStats.connection_id).all()
+    return {"connections": jsonable_encoder(connections)}
+
+
+NDJSON_BATCH_SIZE = 1000  # Rows fetched per round trip when streaming NDJSON
+LIST_PARAMETERS = {"skip", "limit", "after", "format", "fields", "sort"}  # Not column filters
+FILTER_OPERATORS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+
+
+class ListQuery(NamedTuple):
+    """
+    The filters, projection and order of a list request, compiled to SQL expressions.
+
+    **Attributes:**
+    - `fields (list[str])`: Columns to return, or `None` for whole records.
+    - `conditions (list)`: `WHERE` clauses.
+    - `order_by (list)`: `ORDER BY` clauses, always ending with the primary key.
+    - `custom_sort (bool)`: Whether a custom sort was requested.
+    """
+    fields: Optional[List[str]]
+    conditions: list
+    order_by: list
+    custom_sort: bool
+
+
+def parse_list_query(request: Request, model, fields: Optional[str], sort: Optional[str]) -> ListQuery:
+    """
+    Compile the filter, `fields` and `sort` query parameters of a list request.
+
+    Any query parameter named after a column filters on equality, or on a range with a `__gt`,
+    `__gte`, `__lt` or `__lte` suffix. Values are converted to the column's type, so the filters
+    compile to plain indexed comparisons. Equality on text columns ignores case by comparing
+    `lower(column)`, which the `*_lower` expression indexes serve on the customers and movies tables;
+    the other text columns are in small tables or, like `like_status`, too unselective to index.
+    Parameters that are not columns are ignored.
+
+    **Parameters:**
+    - `request (Request)`: The incoming request.
+    - `model`: The SQLAlchemy model being listed.
+    - `fields (str, optional)`: Comma-separated columns to return; the primary key is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, each prefixed with `-` for descending.
+
+    **Returns:**
+    - `list_query (ListQuery)`: The compiled request.
+
+    **Raises:**
+    - `HTTPException (400)`: If a filter value has the wrong type, or `fields`/`sort` name an unknown column.
+    """
+    columns = model.__mapper__.columns
+    key = model.__mapper__.primary_key[0]
+
+    conditions = []
+    for name, raw in request.query_params.multi_items():
+        column_name, _, suffix = name.partition("__")
+        if name in LIST_PARAMETERS or column_name not in columns or (suffix and suffix not in FILTER_OPERATORS):
+            continue
+        try:
+            value = TypeAdapter(columns[column_name].type.python_type).validate_python(raw)
+        except ValidationError:
+            raise HTTPException(status_code=400, detail=f"Invalid value for {name}: {raw!r}.")
+        attribute = getattr(model, column_name)
+        if suffix:
+            conditions.append(FILTER_OPERATORS[suffix](attribute, value))
+        elif isinstance(value, str):
+            conditions.append(func.lower(attribute) == value.lower())
+        else:
+            conditions.append(attribute == value)
+
+    projection = None
+    if fields:
+        projection = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in projection if name not in columns]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}.")
+        if key.key not in projection:
+            projection.insert(0, key.key)
+
+    order_by = []
+    for name in (sort or "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        column_name = name.lstrip("-")
+        if column_name not in columns:
+            raise HTTPException(status_code=400, detail=f"Unknown sort field: {column_name}.")
+        attribute = getattr(model, column_name)
+        order_by.append(attribute.desc() if name.startswith("-") else attribute.asc())
+    custom_sort = bool(order_by)
+    order_by.append(key)
+
+    return ListQuery(projection, conditions, order_by, custom_sort)
+
+
+def build_list_query(db: Session, model, list_query: ListQuery, after: Optional[int] = None):
+    """
+    Build the ORM query for a compiled list request.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `model`: The SQLAlchemy model being listed.
+    - `list_query (ListQuery)`: The compiled request.
+    - `after (int, optional)`: Only include records whose primary key is greater than this.
+
+    **Returns:**
+    - `query (Query)`: The query, not yet executed.
+    """
+    if list_query.fields is None:
+        query = db.query(model)
+    else:
+        query = db.query(*[getattr(model, name) for name in list_query.fields])
+    if after is not None:
+        query = query.filter(model.__mapper__.primary_key[0] > after)
+    return query.filter(*list_query.conditions).order_by(*list_query.order_by)
+
+
+def serialize_row(row, schema, list_query: ListQuery) -> dict:
+    """
+    Convert a record or a projected row to JSON-compatible values.
+
+    **Parameters:**
+    - `row`: An ORM record, or a row of the projected columns.
+    - `schema`: The Pydantic schema of a whole record.
+    - `list_query (ListQuery)`: The compiled request.
+
+    **Returns:**
+    - `data (dict)`: The row as a dictionary.
+    """
+    if list_query.fields is None:
+        return schema.model_validate(row, from_attributes=True).model_dump(mode="json")
+    return jsonable_encoder(dict(row._mapping))
+
+
+def stream_ndjson(model, schema, list_query: ListQuery, after: Optional[int] = None):
+    """
+    Stream every matching record after a cursor as newline-delimited JSON.
+
+    Rows are read from a server-side cursor, so memory use does not grow with the size of the
+    table. The stream uses its own session, because the request's session is closed before the
+    response body is sent.
+
+    **Parameters:**
+    - `model`: The SQLAlchemy model to read.
+    - `schema`: The Pydantic schema each record is serialized with.
+    - `list_query (ListQuery)`: The compiled filters, projection and order.
+    - `after (int, optional)`: Only stream records whose primary key is greater than this.
+
+    **Returns:**
+    - `StreamingResponse`: An `application/x-ndjson` response with one record per line.
+    """
+    def rows():
+        db = SessionLocal()
+        try:
+            query = build_list_query(db, model, list_query, after)
+            for row in query.yield_per(NDJSON_BATCH_SIZE):
+                yield json.dumps(serialize_row(row, schema, list_query)) + "\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+
+def render_page(db: Session, model, schema, list_query: ListQuery, skip: int, limit: int, after: Optional[int]):
+    """
+    Read one page of a list request and serialize it.
+
+    With `after`, the page starts after that primary key (keyset pagination), which costs the same
+    at any depth; without it, `skip` rows are skipped. When the page is full, the cursor for the
+    next page is returned in the `X-Next-Cursor` header.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `model`: The SQLAlchemy model to read.
+    - `schema`: The Pydantic schema of a record.
+    - `list_query (ListQuery)`: The compiled filters, projection and order.
+    - `skip (int)`: The number of records to skip, when `after` is not given.
+    - `limit (int)`: The number of records to return.
+    - `after (int, optional)`: Primary key of the last record of the previous page.
+
+    **Returns:**
+    - `body (bytes)`: The page as a JSON array.
+    - `headers (dict)`: The `X-Next-Cursor` header, if there may be a next page.
+
+    **Raises:**
+    - `HTTPException (400)`: If `after` is combined with a custom `sort`.
+    """
+    if after is not None and list_query.custom_sort:
+        raise HTTPException(status_code=400, detail="after can only be used with the default order.")
+
+    query = build_list_query(db, model, list_query, after)
+    if after is None:
+        query = query.offset(skip)
+    rows = query.limit(limit).all()
+
+    headers = {}
+    if rows and len(rows) == limit and not list_query.custom_sort:
+        key = model.__mapper__.primary_key[0].key
+        headers["X-Next-Cursor"] = str(getattr(rows[-1], key))
+    body = json.dumps([serialize_row(row, schema, list_query) for row in rows]).encode()
+    return body, headers
+
+
+def read_page(request: Request, db: Session, model, schema, skip: int, limit: int, after: Optional[int], format: str, fields: Optional[str], sort: Optional[str]):
+    """
+    Answer a list request with one JSON page, or stream all matching records as NDJSON.
+
+    **Parameters:**
+    - `request (Request)`: The incoming request, for its filter parameters.
+    - `db (Session)`: The database session.
+    - `model`: The SQLAlchemy model to read.
+    - `schema`: The Pydantic schema of a record.
+    - `skip (int)`, `limit (int)`, `after (int, optional)`: As for `render_page`; `limit` is ignored for NDJSON.
+    - `format (str)`: `json` for a page, `ndjson` to stream every matching record after `after`.
+    - `fields (str, optional)`, `sort (str, optional)`: As for `parse_list_query`.
+
+    **Returns:**
+    - `Response`: The JSON page, or a `StreamingResponse` for NDJSON.
+    """
+    list_query = parse_list_query(request, model, fields, sort)
+    if format == "ndjson":
+        return stream_ndjson(model, schema, list_query, after)
+
+    body, headers = render_page(db, model, schema, list_query, skip, limit, after)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def read_cached_page(request: Request, db: Session, model, schema, skip: int, limit: int, after: Optional[int], format: str, fields: Optional[str], sort: Optional[str]):
+    """
+    Like `read_page`, but serve JSON pages from `response_cache`, with `ETag` revalidation.
+
+    A page is rendered once, then served from memory until it expires or a write to the table
+    invalidates it. A page whose rendering overlapped such a write is returned but not cached. A request whose `If-None-Match` matches the page's `ETag` gets an empty
+    `304 Not Modified`. NDJSON streams are not cached.
+
+    **Parameters:**
+    - The same as `read_page`.
+
+    **Returns:**
+    - `Response`: The JSON page, a `304` response, or a `StreamingResponse` for NDJSON.
+    """
+    list_query = parse_list_query(request, model, fields, sort)
+    if format == "ndjson":
+        return stream_ndjson(model, schema, list_query, after)
+
+    table = model.__tablename__
+    entry = response_cache.get(table, request.url.query)
+    if entry is None:
+        generation = response_cache.generation(table)
+        body, headers = render_page(db, model, schema, list_query, skip, limit, after)
+        entry = response_cache.set(table, request.url.query, body, headers, generation)
+
+    if request.headers.get("If-None-Match") == entry.etag:
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return Response(content=entry.body, media_type="application/json", headers={"ETag": entry.etag, **entry.headers})
+
+
 # Base Root
 @app.get("/")
 def read_root():
@@ -82,9 +371,11 @@ def read_root():
     return {"message": "Welcome to the FastAPI application!"}
 
 @app.post("/send-emails")
-async def send_emails(request: schemas.EmailRequest, db: Session = Depends(get_db)):
+def send_emails(request: schemas.EmailRequest, db: Session = Depends(get_db)):
     """
-    Send personalized emails to customers in the selected segment and track performance.
+    Queue a campaign of personalized emails to customers in the selected segment.
+
+    The emails are sent by the background worker in `campaigns.py`; poll `/campaigns/{job_id}` for progress.
 
     **Parameters:**
     - `request (schemas.EmailRequest)`: The request body containing the following data:
@@ -93,12 +384,17 @@ async def send_emails(request: schemas.EmailRequest, db: Session = Depends(get_d
         - `text_skeleton_2 (str)`: The second email skeleton message.
         - `ab_test_id_a (int)`: The ID of the A/B test for Variant A.
         - `ab_test_id_b (int)`: The ID of the A/B test for Variant B.
+        - `extra_variants (list, optional)`: Further variants, each with an `ab_test_id` and a `text_skeleton`.
+        - `weights (list[int], optional)`: Relative weights from 1 to 1000 of all variants, in order (default is equal weights).
+        - `stratify_by (str, optional)`: `subscription` or `location`, to balance the variants within each.
 
     **Returns:**
-    - `message (str)`: Success message with the count of emails sent.
+    - `message (str)`: Confirmation that the campaign was queued.
+    - `job_id (int)`: The ID of the queued campaign job.
 
     **Raises:**
-    - `HTTPException (404)`: If the A/B test IDs do not exist or no customers are found for the segment.
+    - `HTTPException (400)`: If the variants, weights or stratification are invalid.
+    - `HTTPException (404)`: If the A/B test IDs do not exist.
     - `HTTPException (500)`: For any unexpected errors.
     """
     segment_name = request.segment_name
@@ -107,83 +403,50 @@ async def send_emails(request: schemas.EmailRequest, db: Session = Depends(get_d
     ab_test_id_a = request.ab_test_id_a  # Passed from the frontend (Variant A)
     ab_test_id_b = request.ab_test_id_b  # Passed from the frontend (Variant B)
 
+    variants = [
+        {"ab_test_id": ab_test_id_a, "text_skeleton": text_skeleton_1},
+        {"ab_test_id": ab_test_id_b, "text_skeleton": text_skeleton_2},
+    ] + [variant.dict() for variant in request.extra_variants or []]
+
     try:
-        # Validate both A/B test IDs exist
-        for ab_test_id in [ab_test_id_a, ab_test_id_b]:
+        # Validate the variants, their weights and the stratification
+        ab_test_ids = [variant["ab_test_id"] for variant in variants]
+        if len(set(ab_test_ids)) != len(ab_test_ids):
+            raise HTTPException(status_code=400, detail="Each variant needs a different A/B test ID.")
+        weights = request.weights or [1] * len(variants)
+        if len(weights) != len(variants) or any(weight <= 0 for weight in weights):
+            raise HTTPException(status_code=400, detail="Weights must be positive and given for every variant.")
+        if any(weight > MAX_WEIGHT for weight in weights):
+            raise HTTPException(status_code=400, detail=f"Weights must not exceed {MAX_WEIGHT}.")
+        for variant, weight in zip(variants, weights):
+            variant["weight"] = weight
+        if request.stratify_by is not None and request.stratify_by not in STRATIFY_COLUMNS:
+            raise HTTPException(
+                status_code=400, detail=f"stratify_by must be one of {', '.join(STRATIFY_COLUMNS)}."
+            )
+
+        # Validate all A/B test IDs exist
+        for ab_test_id in ab_test_ids:
             ab_test = db.query(models1.ABTest).filter(models1.ABTest.ab_test_id == ab_test_id).first()
             if not ab_test:
                 raise HTTPException(status_code=404, detail=f"AB Test with ID {ab_test_id} not found.")
 
-        # Insert a new experiment row with a NULL p-value
-        new_experiment = models1.Experiment(p_value=float(1))
-        db.add(new_experiment)
-        db.commit()
-        db.refresh(new_experiment)
-        experiment_id = new_experiment.experiment_id  # Retrieve the generated experiment ID
-
-        # Fetch target customers
-        target_customers = (
-            db.query(models1.Customer)
-            .join(models1.CustomerSegment, models1.Customer.customer_id == models1.CustomerSegment.customer_id)
-            .join(models1.Segment, models1.CustomerSegment.segment_id == models1.Segment.segment_id)
-            .filter(
-                models1.Segment.segment_name.ilike(segment_name),
-                models1.Customer.customer_id > 2000
-            )
-            .all()
+        # Queue the campaign; the worker in campaigns.py creates the experiment and sends the emails
+        job = models1.CampaignJob(
+            segment_name=segment_name,
+            text_skeleton_1=text_skeleton_1,
+            text_skeleton_2=text_skeleton_2,
+            ab_test_id_a=ab_test_id_a,
+            ab_test_id_b=ab_test_id_b,
+            variants=variants,
+            stratify_by=request.stratify_by,
         )
-
-        if not target_customers:
-            raise HTTPException(
-                status_code=404, detail=f"No customers found for the segment '{segment_name}'."
-            )
-
-        # Split customers into two groups for A/B testing
-        mid_index = len(target_customers) // 2
-        group_a = target_customers[:mid_index]
-        group_b = target_customers[mid_index:]
-
-        # Add tracking links and send emails
-        emails_sent = 0
-
-        for idx, (group, ab_test_id, skeleton) in enumerate([
-            (group_a, ab_test_id_a, text_skeleton_1),
-            (group_b, ab_test_id_b, text_skeleton_2),
-        ]):
-            for customer in group:
-                try:
-                    # Generate tracking link
-                    tracking_token = str(uuid.uuid4())
-                    tracking_url = (
-                        f"http://localhost:8000/track/click/{ab_test_id}/{experiment_id}/{customer.customer_id}/{tracking_token}"
-                    )
-
-                    # Insert click tracking data into ab_test_results
-                    ab_test_result = models1.ABTestResult(
-                        ab_test_id=ab_test_id,
-                        experiment_id=experiment_id,
-                        customer_id=customer.customer_id,
-                        clicked_link=False,  # Default to False; updated upon click
-                    )
-                    db.add(ab_test_result)
-
-                    # Send email
-                    first_name = customer.name.split(" ")[0]
-                    email_body = f"{skeleton}\n\nClick here to learn more: {tracking_url}"
-                    send_email(
-                        recipient_email=[customer.email],
-                        subject="Exciting News",
-                        body=f"Hi {first_name}!\n\n{email_body}",
-                    )
-                    logger.info(f"Email sent successfully to {customer.email}.")
-                    emails_sent += 1
-                except Exception as e:
-                    logger.warning(f"Failed to send email to {customer.email}: {e}")
-
-        # Commit tracking data to the database
+        db.add(job)
         db.commit()
+        db.refresh(job)
+        logger.info(f"Queued campaign job {job.job_id} for segment '{segment_name}'.")
 
-        return {"message": f"Emails sent successfully to {emails_sent} customers."}
+        return {"message": f"Campaign queued as job {job.job_id}.", "job_id": job.job_id}
 
     except HTTPException as http_exc:
         logger.error(f"HTTP Exception: {http_exc.detail}")
@@ -194,8 +457,52 @@ async def send_emails(request: schemas.EmailRequest, db: Session = Depends(get_d
 
 
 
+@app.get("/campaigns/{job_id}", response_model=schemas.CampaignJob)
+def read_campaign(job_id: int, db: Session = Depends(get_db)):
+    """
+    Report the progress of a queued email campaign.
+
+    **Parameters:**
+    - `job_id (int)`: The ID returned by `/send-emails`.
+
+    **Returns:**
+    - `CampaignJob`: The job status, sent and failed counts, progress and throughput in emails per second.
+
+    **Raises:**
+    - `HTTPException (404)`: If the job does not exist.
+    """
+    job = db.query(models1.CampaignJob).filter(models1.CampaignJob.job_id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Campaign job with ID {job_id} not found.")
+
+    processed = job.sent + job.failed
+    progress = processed / job.total if job.total else None
+    throughput = None
+    if job.started_at is not None:
+        started_at = job.started_at.replace(tzinfo=timezone.utc)
+        finished_at = job.finished_at.replace(tzinfo=timezone.utc) if job.finished_at else datetime.now(timezone.utc)
+        elapsed = (finished_at - started_at).total_seconds()
+        throughput = processed / elapsed if elapsed > 0 else None
+
+    return schemas.CampaignJob(
+        job_id=job.job_id,
+        status=job.status,
+        segment_name=job.segment_name,
+        experiment_id=job.experiment_id,
+        total=job.total,
+        sent=job.sent,
+        failed=job.failed,
+        progress=progress,
+        throughput=throughput,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
 @app.get("/track/click/{ab_test_id}/{experiment_id}/{customer_id}/{click_token}")
-async def track_click(
+def track_click(
     ab_test_id: int,
     experiment_id: int,
     customer_id: int,
@@ -205,50 +512,66 @@ async def track_click(
     """
     Endpoint to track a click event for a specific customer in an A/B test.
 
+    The signed `click_token` is verified and recently seen clicks are rejected in memory, before
+    any query; a click is forgotten again if it could not be recorded. The click is then recorded with a single conditional `UPDATE`. When the click buffer is enabled
+    (`CLICK_BUFFER_ENABLED=true`), it is queued and written with other clicks a few hundred
+    milliseconds later instead, and missing or repeated clicks are not reported.
+
     **Parameters:**
     - `ab_test_id (int)`: The ID of the A/B test.
     - `experiment_id (int)`: The ID of the experiment.
     - `customer_id (int)`: The ID of the customer.
-    - `click_token (str)`: The unique token for tracking the click.
+    - `click_token (str)`: The HMAC token signing the three IDs (see `email_utils.generate_click_token`).
 
     **Returns:**
     - Success message if the click is tracked successfully.
 
     **Raises:**
+    - `HTTPException (403)`: If the click token is not valid for these IDs.
     - `HTTPException (404)`: If no matching record is found.
     - `HTTPException (400)`: If the click has already been tracked.
     """
+    if not verify_click_token(click_token, ab_test_id, experiment_id, customer_id):
+        logger.warning(f"Rejected forged click token for customer_id={customer_id}.")
+        raise HTTPException(status_code=403, detail="Invalid click token.")
+
+    if recent_clicks.seen(ab_test_id, experiment_id, customer_id):
+        raise HTTPException(status_code=400, detail="Click has already been tracked for this customer.")
+
+    if CLICK_BUFFER_ENABLED:
+        click_buffer.add(ab_test_id, experiment_id, customer_id)
+        return {"message": "Click tracked successfully"}
+
     try:
-        # Fetch the click record
-        click_record = db.query(models1.ABTestResult).filter(
-            models1.ABTestResult.ab_test_id == ab_test_id,
+        if record_click(db, ab_test_id, experiment_id, customer_id):
+            db.commit()
+            return {"message": "Click tracked successfully"}
+
+        # Nothing was updated: find out whether the record is missing or already clicked
+        click_record = db.query(models1.ABTestResult.clicked_link).filter(
             models1.ABTestResult.experiment_id == experiment_id,
+            models1.ABTestResult.ab_test_id == ab_test_id,
             models1.ABTestResult.customer_id == customer_id,
         ).first()
 
         if not click_record:
+            # Not a duplicate: forget it, so a retry once the record exists is not rejected as one
+            recent_clicks.forget(ab_test_id, experiment_id, customer_id)
             raise HTTPException(
                 status_code=404, 
                 detail=f"No click record found for ab_test_id={ab_test_id}, experiment_id={experiment_id}, customer_id={customer_id}."
             )
 
-        # Check if the click has already been tracked
-        if click_record.clicked_link:
-            raise HTTPException(
-                status_code=400,
-                detail="Click has already been tracked for this customer."
-            )
-
-        # Update the record to mark the click
-        click_record.clicked_link = True
-        db.commit()
-
-        return {"message": "Click tracked successfully"}
+        raise HTTPException(
+            status_code=400,
+            detail="Click has already been tracked for this customer."
+        )
 
     except HTTPException as http_exc:
         logger.error(f"HTTP Exception: {http_exc.detail}")
         raise http_exc
     except Exception as e:
+        recent_clicks.forget(ab_test_id, experiment_id, customer_id)
         logger.error(f"An unexpected error occurred: {str(e)}")
         raise HTTPException(
             status_code=500,
@@ -256,6 +579,40 @@ async def track_click(
         )
 
 
+@app.on_event("startup")
+def start_click_buffer():
+    """
+    Start flushing buffered clicks in the background, if the click buffer is enabled.
+    """
+    if CLICK_BUFFER_ENABLED:
+        click_buffer.start()
+
+
+@app.on_event("shutdown")
+def stop_click_buffer():
+    """
+    Write any buffered clicks before the application exits.
+    """
+    if CLICK_BUFFER_ENABLED:
+        click_buffer.stop()
+
+
+@app.on_event("startup")
+def start_segment_counts_refresher():
+    """
+    Start refreshing the `segment_counts` view in the background after segment writes.
+    """
+    segment_counts_refresher.start()
+
+
+@app.on_event("shutdown")
+def stop_segment_counts_refresher():
+    """
+    Apply a pending `segment_counts` refresh before the application exits.
+    """
+    segment_counts_refresher.stop()
+
+
 # CRUD for Segments
 @app.post("/segments/", response_model=schemas.Segment)
 def create_segment(segment: schemas.SegmentCreate, db: Session = Depends(get_db)):
@@ -274,39 +631,162 @@ def create_segment(segment: schemas.SegmentCreate, db: Session = Depends(get_db)
     db_segment = models1.Segment(**segment.dict())
     db.add(db_segment)
     db.commit()
+    response_cache.invalidate("segments")
+    segment_counts_refresher.mark_dirty()  # List the new segment in the counts
     db.refresh(db_segment)
     return db_segment
 
 @app.get("/segments/", response_model=list[schemas.Segment])
-def read_segments(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_segments(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of segments with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
+    Served from the in-process response cache, with `ETag`/`If-None-Match` support.
+
     **Returns:**
     - A list of segments from the database.
     """
-    return db.query(models1.Segment).offset(skip).limit(limit).all()
+    return read_cached_page(request, db, models1.Segment, schemas.Segment, skip, limit, after, format, fields, sort)
+
+
+@app.get("/segments/stats/", response_model=list[schemas.SegmentCount])
+def read_segment_stats(db: Session = Depends(get_db)):
+    """
+    Fetch the number of customers in each segment.
+
+    The counts are read from the `segment_counts` materialized view, which is refreshed after the
+    ETL load and every segmentation run, and within `SEGMENT_COUNTS_REFRESH_INTERVAL` seconds of
+    a segment or customer segment being created through the API.
+
+    **Returns:**
+    - A list of segments with their customer counts.
+    """
+    rows = db.execute(text(
+        "SELECT segment_id, segment_name, customers FROM segment_counts ORDER BY segment_id"
+    )).mappings().all()
+    return [schemas.SegmentCount(**row) for row in rows]
 
 
 @app.get("/experiments/", response_model=list[schemas.Experiment])
-def read_segments(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_segments(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of segments with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
     **Returns:**
     - A list of segments from the database.
     """
-    return db.query(models1.Experiment).offset(skip).limit(limit).all()
+    return read_page(request, db, models1.Experiment, schemas.Experiment, skip, limit, after, format, fields, sort)
+
+
+def experiment_summary(db: Session, experiment_id: int) -> schemas.ExperimentSummary:
+    """
+    Summarize the results of an experiment per variant.
+
+    The counts come from `ab_test_counters`, one row per variant. Experiments recorded before the
+    counters existed fall back to one grouped query over `ab_test_results`, served by its
+    covering index on `experiment_id`.
+
+    **Parameters:**
+    - `db (Session)`: The database session.
+    - `experiment_id (int)`: The ID of the experiment.
+
+    **Returns:**
+    - `ExperimentSummary`: The exposures, clicks and CTR of each variant, and the experiment's p-value.
+
+    **Raises:**
+    - `HTTPException (404)`: If the experiment does not exist.
+    """
+    experiment = db.query(models1.Experiment).filter(models1.Experiment.experiment_id == experiment_id).first()
+    if not experiment:
+        raise HTTPException(status_code=404, detail=f"Experiment with ID {experiment_id} not found.")
+
+    counts = (
+        db.query(models1.ABTestCounter.ab_test_id, models1.ABTestCounter.exposures, models1.ABTestCounter.clicks)
+        .filter(models1.ABTestCounter.experiment_id == experiment_id)
+        .order_by(models1.ABTestCounter.ab_test_id)
+        .all()
+    )
+    if not counts:
+        counts = (
+            db.query(
+                models1.ABTestResult.ab_test_id,
+                func.count().label("exposures"),
+                func.count().filter(models1.ABTestResult.clicked_link).label("clicks"),
+            )
+            .filter(models1.ABTestResult.experiment_id == experiment_id)
+            .group_by(models1.ABTestResult.ab_test_id)
+            .order_by(models1.ABTestResult.ab_test_id)
+            .all()
+        )
+
+    return schemas.ExperimentSummary(
+        experiment_id=experiment_id,
+        p_value=experiment.p_value,
+        variants=[
+            schemas.VariantSummary(
+                ab_test_id=ab_test_id,
+                exposures=exposures,
+                clicks=clicks,
+                ctr=clicks / exposures if exposures else None,
+            )
+            for ab_test_id, exposures, clicks in counts
+        ],
+    )
+
+
+# Declared before `/experiments/{experiment_id}/summary`, so "latest" is not parsed as an ID
+@app.get("/experiments/latest/summary", response_model=schemas.ExperimentSummary)
+def read_latest_experiment_summary(db: Session = Depends(get_db)):
+    """
+    Summarize the results of the most recent experiment that has recorded exposures.
+
+    **Returns:**
+    - `ExperimentSummary`: The exposures, clicks and CTR of each variant, and the experiment's p-value.
+
+    **Raises:**
+    - `HTTPException (404)`: If no experiment has results yet.
+    """
+    experiment_id = db.query(func.max(models1.ABTestResult.experiment_id)).scalar()
+    if experiment_id is None:
+        raise HTTPException(status_code=404, detail="No experiment results found.")
+    return experiment_summary(db, experiment_id)
+
+
+@app.get("/experiments/{experiment_id}/summary", response_model=schemas.ExperimentSummary)
+def read_experiment_summary(experiment_id: int, db: Session = Depends(get_db)):
+    """
+    Summarize the results of an experiment per variant.
+
+    **Parameters:**
+    - `experiment_id (int)`: The ID of the experiment.
+
+    **Returns:**
+    - `ExperimentSummary`: The exposures, clicks and CTR of each variant, and the experiment's p-value.
+
+    **Raises:**
+    - `HTTPException (404)`: If the experiment does not exist.
+    """
+    return experiment_summary(db, experiment_id)
 
 
 from sqlalchemy import text
@@ -347,19 +827,24 @@ def create_customer(customer: schemas.CustomerCreate, db: Session = Depends(get_
     )
 
 @app.get("/customers/", response_model=list[schemas.Customer])
-def read_customers(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_customers(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of customers with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
     **Returns:**
     - A list of customers from the database.
     """
-    return db.query(models1.Customer).offset(skip).limit(limit).all()
+    return read_page(request, db, models1.Customer, schemas.Customer, skip, limit, after, format, fields, sort)
 
 # CRUD for Customer Segments
 @app.post("/customer_segments/", response_model=schemas.CustomerSegment)
@@ -378,23 +863,29 @@ def create_customer_segment(customer_segment: schemas.CustomerSegmentCreate, db:
     db_customer_segment = models1.CustomerSegment(**customer_segment.dict())
     db.add(db_customer_segment)
     db.commit()
+    segment_counts_refresher.mark_dirty()  # Count the customer in its segment
     db.refresh(db_customer_segment)
     return db_customer_segment
 
 @app.get("/customer_segments/", response_model=list[schemas.CustomerSegment])
-def read_customer_segments(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_customer_segments(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of customer segments with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
     **Returns:**
     - A list of customer segments from the database.
     """
-    return db.query(models1.CustomerSegment).offset(skip).limit(limit).all()
+    return read_page(request, db, models1.CustomerSegment, schemas.CustomerSegment, skip, limit, after, format, fields, sort)
 
 # CRUD for Movies
 @app.post("/movies/", response_model=schemas.Movie)
@@ -417,23 +908,31 @@ def create_movie(movie: schemas.MovieCreate, db: Session = Depends(get_db)):
     db_movie = models1.Movie(**movie.dict())
     db.add(db_movie)
     db.commit()
+    response_cache.invalidate("movies")
     db.refresh(db_movie)
     return db_movie
 
 @app.get("/movies/", response_model=list[schemas.Movie])
-def read_movies(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_movies(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of movies with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
+    Served from the in-process response cache, with `ETag`/`If-None-Match` support.
+
     **Returns:**
     - A list of movies from the database.
     """
-    return db.query(models1.Movie).offset(skip).limit(limit).all()
+    return read_cached_page(request, db, models1.Movie, schemas.Movie, skip, limit, after, format, fields, sort)
 
 # CRUD for Engagements
 @app.post("/engagements/", response_model=schemas.Engagement)
@@ -462,13 +961,18 @@ def create_engagement(engagement: schemas.EngagementCreate, db: Session = Depend
     return db_engagement
 
 @app.get("/engagements/", response_model=list[schemas.Engagement])
-def read_engagements(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_engagements(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of engagements with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
     **Returns:**
@@ -477,8 +981,7 @@ def read_engagements(skip: int = 0, limit: int = 10, db: Session = Depends(get_d
     **Raises:**
     - `HTTPException`: If there's an issue retrieving the records, raises a 500 error.
     """
-
-    return db.query(models1.Engagement).offset(skip).limit(limit).all()
+    return read_page(request, db, models1.Engagement, schemas.Engagement, skip, limit, after, format, fields, sort)
 
 # CRUD for Subscriptions
 @app.post("/subscriptions/", response_model=schemas.Subscription)
@@ -500,26 +1003,34 @@ def create_subscription(subscription: schemas.SubscriptionCreate, db: Session =
     db_subscription = models1.Subscription(**subscription.dict())
     db.add(db_subscription)
     db.commit()
+    response_cache.invalidate("subscriptions")
     db.refresh(db_subscription)
     return db_subscription
 
 @app.get("/subscriptions/", response_model=list[schemas.Subscription])
-def read_subscriptions(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_subscriptions(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of subscriptions with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
+    Served from the in-process response cache, with `ETag`/`If-None-Match` support.
+
     **Returns:**
     - A list of subscription records from the database.
     
     **Raises:**
     - `HTTPException`: If there's an issue retrieving the records, raises a 500 error.
     """
-    return db.query(models1.Subscription).offset(skip).limit(limit).all()
+    return read_cached_page(request, db, models1.Subscription, schemas.Subscription, skip, limit, after, format, fields, sort)
 
 # CRUD for AB Tests
 @app.post("/ab_tests/", response_model=schemas.ABTest)
@@ -543,26 +1054,34 @@ def create_ab_test(ab_test: schemas.ABTestCreate, db: Session = Depends(get_db))
     db_ab_test = models1.ABTest(**ab_test.dict())
     db.add(db_ab_test)
     db.commit()
+    response_cache.invalidate("ab_tests")
     db.refresh(db_ab_test)
     return db_ab_test
 
 @app.get("/ab_tests/", response_model=list[schemas.ABTest])
-def read_ab_tests(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def read_ab_tests(request: Request, skip: int = 0, limit: int = 10, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of A/B tests with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
+    Served from the in-process response cache, with `ETag`/`If-None-Match` support.
+
     **Returns:**
     - A list of A/B test records from the database.
     
     **Raises:**
     - `HTTPException`: If there's an issue retrieving the records, raises a 500 error.
     """
-    return db.query(models1.ABTest).offset(skip).limit(limit).all()
+    return read_cached_page(request, db, models1.ABTest, schemas.ABTest, skip, limit, after, format, fields, sort)
 
 # CRUD for AB Test Results
 @app.post("/ab_test_results/", response_model=schemas.ABTestResult)
@@ -589,13 +1108,18 @@ def create_ab_test_result(ab_test_result: schemas.ABTestResultCreate, db: Sessio
     return db_ab_test_result
 
 @app.get("/ab_test_results/", response_model=list[schemas.ABTestResult])
-def read_ab_test_results(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
+def read_ab_test_results(request: Request, skip: int = 0, limit: int = 1000, after: Optional[int] = None, format: Literal["json", "ndjson"] = "json", fields: Optional[str] = None, sort: Optional[str] = None, db: Session = Depends(get_db)):
     """
     Fetch a list of A/B test results with pagination.
     
     **Parameters:**
     - `skip (int, optional)`: The number of records to skip (default is 0).
     - `limit (int, optional)`: The number of records to return (default is 10).
+    - `after (int, optional)`: Return records after this ID instead of skipping; the next page's cursor is in the `X-Next-Cursor` header.
+    - `format (str, optional)`: `json` (default), or `ndjson` to stream every record after `after`.
+    - `fields (str, optional)`: Comma-separated columns to return; the ID is always included.
+    - `sort (str, optional)`: Comma-separated columns to sort by, `-` for descending (default is by ID).
+    - Any other column name filters on equality, or on a range with a `__gt`, `__gte`, `__lt` or `__lte` suffix.
     - `db (Session, optional)`: The database session provided by dependency injection.
     
     **Returns:**
@@ -604,5 +1128,5 @@ def read_ab_test_results(skip: int = 0, limit: int = 1000, db: Session = Depends
     **Raises:**
     - `HTTPException`: If there's an issue retrieving the records, raises a 500 error.
     """
-    return db.query(models1.ABTestResult).offset(skip).limit(limit).all()
+    return read_page(request, db, models1.ABTestResult, schemas.ABTestResult, skip, limit, after, format, fields, sort)
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import text, Column, Integer, String, Text, Float, Boolean, DateTime, ForeignKey, JSON, Index
 from sqlalchemy.orm import relationship
 from database1 import Base
 from datetime import datetime, timezone
@@ -41,6 +41,12 @@ class Customer(Base):
     """
 
     __tablename__ = "customers"
+    __table_args__ = (
+        # Case-insensitive equality filters of the list endpoint, which compare lower(column)
+        Index("ix_customers_name_lower", text("lower(name)")),
+        Index("ix_customers_email_lower", text("lower(email)")),
+        Index("ix_customers_location_lower", text("lower(location)")),
+    )
     customer_id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     email = Column(String, unique=True, nullable=False)
@@ -66,6 +72,12 @@ class CustomerSegment(Base):
     """
 
     __tablename__ = "customer_segments"
+    __table_args__ = (
+        # Campaign targeting: customers of a segment, answered from the index alone
+        Index("ix_customer_segments_segment_customer", "segment_id", "customer_id"),
+        # Segment of a customer, for joins from customers
+        Index("ix_customer_segments_customer", "customer_id", postgresql_include=["segment_id"]),
+    )
     customer_segment_id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.customer_id"))
     segment_id = Column(Integer, ForeignKey("segments.segment_id"))
@@ -87,6 +99,11 @@ class Movie(Base):
     """
 
     __tablename__ = "movies"
+    __table_args__ = (
+        # Case-insensitive equality filters of the list endpoint, which compare lower(column)
+        Index("ix_movies_movie_name_lower", text("lower(movie_name)")),
+        Index("ix_movies_movie_genre_lower", text("lower(movie_genre)")),
+    )
     movie_id = Column(Integer, primary_key=True, index=True)
     movie_name = Column(String, nullable=False)
     movie_rating = Column(Float)
@@ -174,6 +191,10 @@ class ABTestResult(Base):
     """
 
     __tablename__ = "ab_test_results"
+    __table_args__ = (
+        # Click tracking and per-experiment result counts, answered from the index alone
+        Index("ix_ab_test_results_click_covering", "experiment_id", "ab_test_id", "customer_id", postgresql_include=["clicked_link"]),
+    )
     result_id = Column(Integer, primary_key=True, index=True, autoincrement = True)
     ab_test_id = Column(Integer, ForeignKey("ab_tests.ab_test_id"))
     experiment_id = Column(Integer, ForeignKey("experiments.experiment_id"))
@@ -197,3 +218,128 @@ class Experiment(Base):
     experiment_id = Column(Integer, primary_key=True, index=True, autoincrement = True)
     p_value = Column(Float)
     ab_test_results = relationship("ABTestResult", back_populates="experiment")
+
+# AB Test Counters Model
+class ABTestCounter(Base):
+    """
+    Running exposure and click counters for one variant of an experiment.
+
+    The counters are maintained by the campaign worker (exposures, in `campaigns.assign_customers`) and
+    `/track/click` (clicks), through `counters.increment_ab_test_counter`, so experiment results can be
+    read without scanning `ab_test_results`.
+
+    **Attributes:**
+    - `experiment_id (int)`: Foreign key linking to the `Experiment` model (part of the primary key).
+    - `ab_test_id (int)`: Foreign key linking to the `ABTest` model (part of the primary key).
+    - `exposures (int)`: Number of customers assigned to the variant.
+    - `clicks (int)`: Number of customers who clicked the tracking link.
+    """
+    __tablename__ = "ab_test_counters"
+    experiment_id = Column(Integer, ForeignKey("experiments.experiment_id"), primary_key=True)
+    ab_test_id = Column(Integer, ForeignKey("ab_tests.ab_test_id"), primary_key=True)
+    exposures = Column(Integer, nullable=False, default=0)
+    clicks = Column(Integer, nullable=False, default=0)
+
+# Campaign Jobs Model
+class CampaignJob(Base):
+    """
+    A queued `/send-emails` campaign, processed in the background by `campaigns.py`.
+
+    **Attributes:**
+    - `job_id (int)`: Primary key for the job.
+    - `status (str)`: One of `queued`, `running`, `completed` or `failed`.
+    - `segment_name (str)`: Name of the targeted customer segment.
+    - `text_skeleton_1 (str)`: Email skeleton for variant A.
+    - `text_skeleton_2 (str)`: Email skeleton for variant B.
+    - `ab_test_id_a (int)`: Foreign key linking to the `ABTest` model for variant A.
+    - `ab_test_id_b (int)`: Foreign key linking to the `ABTest` model for variant B.
+    - `variants (list)`: Every variant as `{"ab_test_id", "text_skeleton", "weight"}`, starting with A and B.
+    - `stratify_by (str)`: Customer attribute to balance the variants within (`subscription` or `location`), if any.
+    - `experiment_id (int)`: Foreign key linking to the `Experiment` created for the campaign, once started.
+    - `total (int)`: Number of targeted customers, once known.
+    - `sent (int)`: Number of emails sent so far.
+    - `failed (int)`: Number of emails that could not be sent.
+    - `resume_after (int)`: Customer ID up to which every email has been processed, so a requeued job resumes after it.
+    - `error (str)`: Reason the job failed, if it did.
+    - `created_at (DateTime)`: When the job was queued.
+    - `started_at (DateTime)`: When a worker first picked the job up.
+    - `heartbeat_at (DateTime)`: When the worker running the job last reported it was alive.
+    - `finished_at (DateTime)`: When the job completed or failed.
+    """
+    __tablename__ = "campaign_jobs"
+    job_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    status = Column(String, nullable=False, default="queued", index=True)
+    segment_name = Column(String, nullable=False)
+    text_skeleton_1 = Column(Text, nullable=False)
+    text_skeleton_2 = Column(Text, nullable=False)
+    ab_test_id_a = Column(Integer, ForeignKey("ab_tests.ab_test_id"), nullable=False)
+    ab_test_id_b = Column(Integer, ForeignKey("ab_tests.ab_test_id"), nullable=False)
+    variants = Column(JSON)
+    stratify_by = Column(String)
+    experiment_id = Column(Integer, ForeignKey("experiments.experiment_id"))
+    total = Column(Integer)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    resume_after = Column(Integer)
+    error = Column(Text)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+# Email Pool Stats Model
+class EmailPoolStats(Base):
+    """
+    Throughput of one SMTP connection of the campaign worker's pool, written by the worker.
+
+    **Attributes:**
+    - `connection_id (int)`: Primary key, the connection's slot in the pool.
+    - `messages (int)`: Number of messages sent over the connection.
+    - `errors (int)`: Number of failed send attempts on the connection.
+    - `send_seconds (float)`: Total time spent sending messages.
+    - `messages_per_second (float)`: Messages per second of sending time.
+    - `updated_at (DateTime)`: When the worker last reported the connection.
+    """
+    __tablename__ = "email_pool_stats"
+    connection_id = Column(Integer, primary_key=True)
+    messages = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    send_seconds = Column(Float, nullable=False, default=0.0)
+    messages_per_second = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime)
+
+# Indexes replaced by a differently defined index under a new name, dropped on startup.
+# `ix_ab_test_results_click` had no INCLUDE column, so it could not serve index-only scans.
+SUPERSEDED_INDEXES = ["ix_ab_test_results_click"]
+
+# Segment Counts Materialized View
+# Customers per segment, for the dashboard. Created by the API on startup and refreshed after the
+# ETL load, after the segmentation job rewrites `customer_segments` and, in the background (see
+# `segment_counts.py`), after segments or customer segments are created through the API. The
+# unique index allows `REFRESH MATERIALIZED VIEW CONCURRENTLY`, which does not block readers.
+SEGMENT_COUNTS_DDL = [
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS segment_counts AS
+    SELECT segments.segment_id, segments.segment_name, COUNT(customer_segments.customer_id) AS customers
+    FROM segments
+    LEFT JOIN customer_segments ON customer_segments.segment_id = segments.segment_id
+    GROUP BY segments.segment_id, segments.segment_name
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_segment_counts_segment ON segment_counts (segment_id)",
+]
+REFRESH_SEGMENT_COUNTS = "REFRESH MATERIALIZED VIEW CONCURRENTLY segment_counts"
+
+
+def create_segment_counts_view(bind):
+    """
+    Create the `segment_counts` materialized view if it is missing, and refresh it.
+
+    The refresh picks up segments and assignments loaded while the API was not running.
+
+    **Parameters:**
+    - `bind (Engine)`: The engine to run the statements on.
+    """
+    with bind.begin() as connection:
+        for statement in SEGMENT_COUNTS_DDL:
+            connection.execute(text(statement))
+        connection.execute(text(REFRESH_SEGMENT_COUNTS))
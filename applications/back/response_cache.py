@@ -0,0 +1,125 @@
+"""
+In-process cache for responses of read-mostly endpoints.
+
+Entries are grouped by table, so a write to a table can drop every cached page of it at once.
+Every table also has a generation, bumped on invalidation, so a page rendered from data read before
+a write is not cached after the write invalidated the table. Each entry carries an `ETag`, letting clients revalidate with `If-None-Match` and get a `304`.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+RESPONSE_CACHE_SIZE = 256  # Cached responses kept before the least recently used is evicted
+RESPONSE_CACHE_TTL = 60.0  # Seconds a response is served from memory (bounds staleness across workers)
+
+
+class CachedResponse(NamedTuple):
+    """
+    A cached response body with its validator.
+
+    **Attributes:**
+    - `body (bytes)`: The serialized response body.
+    - `etag (str)`: Quoted hash of the body, for the `ETag` header.
+    - `headers (dict)`: Extra headers to send with the body.
+    - `expires_at (float)`: `time.monotonic()` after which the entry is stale.
+    """
+    body: bytes
+    etag: str
+    headers: Dict[str, str]
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    A thread-safe TTL and LRU cache of response bodies, keyed by table and request.
+
+    **Attributes:**
+    - `maxsize (int)`: Number of responses kept.
+    - `ttl (float)`: Seconds each response stays fresh.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, table: str) -> int:
+        """
+        Return the table's generation, to pass to `set` once the response is rendered.
+
+        **Parameters:**
+        - `table (str)`: The table the response is read from.
+
+        **Returns:**
+        - `generation (int)`: The number of times the table was invalidated.
+        """
+        with self._lock:
+            return self._generations.get(table, 0)
+
+    def get(self, table: str, key: str) -> Optional[CachedResponse]:
+        """
+        Look up a fresh cached response.
+
+        **Parameters:**
+        - `table (str)`: The table the response was read from.
+        - `key (str)`: What distinguishes the request, e.g. its query string.
+
+        **Returns:**
+        - `entry (CachedResponse)`: The cached response, or `None` if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get((table, key))
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[(table, key)]
+                return None
+            self._entries.move_to_end((table, key))
+            return entry
+
+    def set(self, table: str, key: str, body: bytes, headers: Optional[Dict[str, str]] = None,
+            generation: Optional[int] = None) -> CachedResponse:
+        """
+        Cache a response body, unless the table was invalidated since `generation`.
+
+        **Parameters:**
+        - `table (str)`: The table the response was read from.
+        - `key (str)`: What distinguishes the request, e.g. its query string.
+        - `body (bytes)`: The serialized response body.
+        - `headers (dict, optional)`: Extra headers to send with the body.
+        - `generation (int, optional)`: The table's `generation` taken before reading the data (default is
+          to cache unconditionally).
+
+        **Returns:**
+        - `entry (CachedResponse)`: The entry, including its `ETag`; it is not stored if the table was invalidated.
+        """
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        entry = CachedResponse(body, etag, headers or {}, time.monotonic() + self.ttl)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(table, 0):
+                return entry
+            self._entries[(table, key)] = entry
+            self._entries.move_to_end((table, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, table: str):
+        """
+        Drop every cached response of a table, e.g. after a write to it.
+
+        **Parameters:**
+        - `table (str)`: The table that changed.
+        """
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == table]:
+                del self._entries[cache_key]
+
+
+response_cache = ResponseCache()
@@ -32,6 +32,19 @@ class Segment(BaseModel):
     segment_name: str
     segment_description: Optional[str] = None
 
+class SegmentCount(BaseModel):
+    """
+    Schema for the number of customers in a segment.
+
+    **Attributes:**
+    - `segment_id (int)`: Unique identifier for the segment.
+    - `segment_name (str)`: Name of the segment.
+    - `customers (int)`: Number of customers assigned to the segment.
+    """
+    segment_id: int
+    segment_name: str
+    customers: int
+
 class Customer(BaseSchema):
     """
     Schema for representing an existing Customer.
@@ -73,6 +86,18 @@ class CustomerCreate(BaseSchema):
     subscription_id: int
 
 
+class EmailVariant(BaseModel):
+    """
+    Schema for an email variant beyond A and B.
+
+    **Attributes:**
+    - `ab_test_id (int)`: A/B test ID for the variant.
+    - `text_skeleton (str)`: Email skeleton for the variant.
+    """
+    ab_test_id: int
+    text_skeleton: str
+
+
 class EmailRequest(BaseModel):
     """
     Schema for the email request.
@@ -83,12 +108,18 @@ class EmailRequest(BaseModel):
     - `text_skeleton_2 (str)`: Second email skeleton.
     - `ab_test_id_a (int)`: A/B test ID for variant A.
     - `ab_test_id_b (int)`: A/B test ID for variant B.
+    - `extra_variants (Optional[List[EmailVariant]])`: Further variants to test alongside A and B.
+    - `weights (Optional[List[int]])`: Relative weights from 1 to 1000 of A, B and the extra variants, in order; equal by default.
+    - `stratify_by (Optional[str])`: Balance the variants within each `subscription` or `location`.
     """
     segment_name: str
     text_skeleton_1: str
     text_skeleton_2: str
     ab_test_id_a : int 
     ab_test_id_b : int
+    extra_variants: Optional[List[EmailVariant]] = None
+    weights: Optional[List[int]] = None
+    stratify_by: Optional[str] = None
 
 class CustomerSegmentCreate(BaseModel):
     """
@@ -262,4 +293,65 @@ class Experiment(BaseModel):
     - `p_value (float)`: P-value indicating the statistical significance of the experiment.
     """
     experiment_id: int
-    p_value: float
\ No newline at end of file
+    p_value: float
+
+class VariantSummary(BaseModel):
+    """
+    Schema for the results of one variant of an experiment.
+
+    **Attributes:**
+    - `ab_test_id (int)`: Identifier of the A/B test variant.
+    - `exposures (int)`: Number of customers assigned to the variant.
+    - `clicks (int)`: Number of customers who clicked the tracking link.
+    - `ctr (Optional[float])`: Click-through rate, `clicks / exposures`.
+    """
+    ab_test_id: int
+    exposures: int
+    clicks: int
+    ctr: Optional[float] = None
+
+class ExperimentSummary(BaseModel):
+    """
+    Schema for the aggregated results of an experiment.
+
+    **Attributes:**
+    - `experiment_id (int)`: Unique identifier for the experiment.
+    - `p_value (Optional[float])`: P-value of the experiment, as last computed by the A/B testing job.
+    - `variants (List[VariantSummary])`: Exposures, clicks and CTR of each variant.
+    """
+    experiment_id: int
+    p_value: Optional[float] = None
+    variants: List[VariantSummary]
+
+class CampaignJob(BaseSchema):
+    """
+    Schema for reporting the progress of a queued email campaign.
+
+    **Attributes:**
+    - `job_id (int)`: Unique identifier for the job.
+    - `status (str)`: One of `queued`, `running`, `completed` or `failed`.
+    - `segment_name (str)`: Name of the targeted customer segment.
+    - `experiment_id (Optional[int])`: Experiment created for the campaign, once started.
+    - `total (Optional[int])`: Number of targeted customers, once known.
+    - `sent (int)`: Number of emails sent so far.
+    - `failed (int)`: Number of emails that could not be sent.
+    - `progress (Optional[float])`: Share of targeted customers processed, between 0 and 1.
+    - `throughput (Optional[float])`: Emails processed per second since the job started.
+    - `error (Optional[str])`: Reason the job failed, if it did.
+    - `created_at (datetime)`: When the job was queued.
+    - `started_at (Optional[datetime])`: When a worker picked the job up.
+    - `finished_at (Optional[datetime])`: When the job completed or failed.
+    """
+    job_id: int
+    status: str
+    segment_name: str
+    experiment_id: Optional[int] = None
+    total: Optional[int] = None
+    sent: int
+    failed: int
+    progress: Optional[float] = None
+    throughput: Optional[float] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
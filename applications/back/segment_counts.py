@@ -0,0 +1,83 @@
+"""
+Background refresh of the `segment_counts` materialized view after API writes.
+
+A refresh recounts every customer segment, so single-row writes do not run it inline. They mark
+the view dirty instead, and `SegmentCountsRefresher` refreshes it once per interval at most,
+however many writes happened in between. Bulk loads (the ETL and the segmentation job) still
+refresh it synchronously when they finish.
+"""
+
+import threading
+
+from loguru import logger
+from sqlalchemy import text
+
+import models1 as models1
+from database1 import engine
+
+SEGMENT_COUNTS_REFRESH_INTERVAL = 5.0  # Seconds between refreshes while writes keep coming
+
+
+class SegmentCountsRefresher:
+    """
+    Refresh `segment_counts` from a background thread when writes have marked it dirty.
+
+    **Attributes:**
+    - `interval (float)`: Seconds between checks; the counts lag behind a write by at most this long.
+    """
+
+    def __init__(self, interval: float = SEGMENT_COUNTS_REFRESH_INTERVAL):
+        self.interval = interval
+        self._dirty = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self):
+        """
+        Request a refresh, after a committed write to `segments` or `customer_segments`.
+        """
+        self._dirty.set()
+
+    def refresh(self) -> bool:
+        """
+        Refresh the view if it is dirty.
+
+        **Returns:**
+        - `refreshed (bool)`: `True` if the view was refreshed.
+        """
+        if not self._dirty.is_set():
+            return False
+        # Cleared first, so a write committed during the refresh marks the view dirty again
+        self._dirty.clear()
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(models1.REFRESH_SEGMENT_COUNTS))
+            return True
+        except Exception as e:
+            self._dirty.set()  # Retry on the next check
+            logger.error(f"Failed to refresh the segment_counts view: {e}")
+            return False
+
+    def start(self):
+        """
+        Start the background refresh thread.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="segment-counts-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and apply a pending refresh.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.refresh()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.refresh()
+
+
+segment_counts_refresher = SegmentCountsRefresher()
@@ -0,0 +1,177 @@
+"""
+Columnar snapshot cache for the per-customer feature frame.
+
+Snapshots are Parquet files keyed by the data version returned by `ds_model.fetch_data_version`,
+so repeated analyses (including from notebooks) load the features from local disk instead of
+re-querying PostgreSQL. Old snapshots are evicted in least-recently-used order, together with
+temporary files left behind by writers that crashed.
+
+Modules:
+    - pyarrow: For writing and memory-mapping Parquet files.
+    - hashlib, json: For deriving snapshot file names and metadata from the data version.
+    - os, time: For file management and LRU bookkeeping.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Directory holding the snapshot files (override with the FEATURE_SNAPSHOT_DIR environment variable)
+SNAPSHOT_DIR = os.environ.get(
+    "FEATURE_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+)
+
+# Number of snapshots kept on disk before the least recently used ones are deleted
+MAX_SNAPSHOTS = 5
+
+# Age in seconds after which a temporary snapshot file is assumed to belong to a crashed writer
+STALE_TEMPORARY_SECONDS = 3600
+
+# Key under which the data version is stored in the Parquet schema metadata
+VERSION_METADATA_KEY = b"ds.data_version"
+
+
+def version_metadata(version):
+    """
+    Serialize a data version for storage in the snapshot metadata.
+
+    **Parameters:**
+    - `version (tuple)`: The data version from `ds_model.fetch_data_version`.
+
+    **Returns:**
+    - `metadata (str)`: A JSON representation of the version.
+    """
+    return json.dumps([str(value) for value in version])
+
+
+def snapshot_path(version, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Return the file path of the snapshot for a data version.
+
+    **Parameters:**
+    - `version (tuple)`: The data version from `ds_model.fetch_data_version`.
+    - `snapshot_dir (str, optional)`: The snapshot directory (default is `SNAPSHOT_DIR`).
+
+    **Returns:**
+    - `path (str)`: The Parquet file path for this version.
+    """
+    digest = hashlib.sha1(version_metadata(version).encode()).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"features_{digest}.parquet")
+
+
+def save_snapshot(features, version, snapshot_dir=SNAPSHOT_DIR, max_snapshots=MAX_SNAPSHOTS):
+    """
+    Write the feature frame as a Parquet snapshot and evict old snapshots.
+
+    The file is written under a temporary name and renamed into place, so readers never load a partial file.
+
+    **Parameters:**
+    - `features (DataFrame)`: The per-customer feature frame.
+    - `version (tuple)`: The data version the frame was built from.
+    - `snapshot_dir (str, optional)`: The snapshot directory (default is `SNAPSHOT_DIR`).
+    - `max_snapshots (int, optional)`: Number of snapshots to keep (default is `MAX_SNAPSHOTS`).
+
+    **Returns:**
+    - `path (str)`: The path of the written snapshot.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = snapshot_path(version, snapshot_dir)
+
+    table = pa.Table.from_pandas(features, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[VERSION_METADATA_KEY] = version_metadata(version).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, temporary_path)
+    os.replace(temporary_path, path)
+
+    evict_snapshots(snapshot_dir, max_snapshots)
+    return path
+
+
+def load_snapshot(version, expected_rows=None, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Load the snapshot for a data version if a valid one exists.
+
+    A snapshot is valid when the data version stored in its metadata matches `version` and the
+    number of rows in its Parquet footer matches `expected_rows`, the row count derived from the
+    database. The file is memory-mapped, and its modification time is refreshed so that LRU
+    eviction keeps recently used snapshots.
+
+    **Parameters:**
+    - `version (tuple)`: The current data version.
+    - `expected_rows (int, optional)`: The number of rows the frame has for this version (default is not checked).
+    - `snapshot_dir (str, optional)`: The snapshot directory (default is `SNAPSHOT_DIR`).
+
+    **Returns:**
+    - `features (DataFrame or None)`: The cached feature frame, or None if there is no valid snapshot.
+    """
+    path = snapshot_path(version, snapshot_dir)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        metadata = parquet_file.schema_arrow.metadata or {}
+        if metadata.get(VERSION_METADATA_KEY) != version_metadata(version).encode():
+            print(f"Ignoring snapshot {path}: data version mismatch.")
+            return None
+
+        if expected_rows is not None and parquet_file.metadata.num_rows != expected_rows:
+            print(f"Ignoring snapshot {path}: {parquet_file.metadata.num_rows} rows, expected {expected_rows}.")
+            return None
+        table = parquet_file.read()
+    except (OSError, pa.ArrowException) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+    os.utime(path, None)
+    return table.to_pandas()
+
+
+def evict_snapshots(snapshot_dir=SNAPSHOT_DIR, max_snapshots=MAX_SNAPSHOTS):
+    """
+    Delete the least recently used snapshots beyond `max_snapshots`, and temporary files older than
+    `STALE_TEMPORARY_SECONDS` left behind by writers that crashed before renaming them into place.
+
+    **Parameters:**
+    - `snapshot_dir (str, optional)`: The snapshot directory (default is `SNAPSHOT_DIR`).
+    - `max_snapshots (int, optional)`: Number of snapshots to keep (default is `MAX_SNAPSHOTS`).
+
+    **Returns:**
+    - `evicted (list)`: The paths of the deleted snapshots and temporary files.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+
+    # Stat every file once; another process may remove it in the meantime
+    snapshots = []
+    temporaries = []
+    for name in os.listdir(snapshot_dir):
+        if not name.startswith("features_") or not name.endswith((".parquet", ".tmp")):
+            continue
+        path = os.path.join(snapshot_dir, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        (snapshots if name.endswith(".parquet") else temporaries).append((mtime, path))
+    snapshots.sort(reverse=True)
+
+    # Temporary files of writers still running are younger than the cutoff
+    cutoff = time.time() - STALE_TEMPORARY_SECONDS
+    stale = [path for mtime, path in temporaries if mtime < cutoff]
+
+    evicted = []
+    for path in [path for _, path in snapshots[max_snapshots:]] + stale:
+        try:
+            os.remove(path)
+            evicted.append(path)
+        except FileNotFoundError:
+            pass
+    return evicted
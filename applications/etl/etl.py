@@ -22,6 +22,7 @@ import time
 import pandas as pd
 from loguru import logger
 import random
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 from data_generator import (
     generate_movie,
@@ -178,3 +179,13 @@ for table in ordered_tables:
         load_csv_to_table(table, csv_file)
 
 print("All tables are populated in the defined order.")
+
+# Refresh the dashboard's segment counts, if the API has already created the view
+with engine.begin() as connection:
+    if connection.execute(text("SELECT to_regclass('segment_counts')")).scalar() is not None:
+        connection.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY segment_counts"))
+        logger.info("Refreshed the segment_counts view.")
+
+# Report any hot query that cannot use an index
+from index_check import check_indexes
+check_indexes()
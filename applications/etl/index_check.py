@@ -0,0 +1,116 @@
+"""
+Index Check Script
+
+This script runs `EXPLAIN` on the hottest query shapes of the platform and reports any that
+would read a table with a sequential scan instead of an index.
+
+Each query is planned with `enable_seqscan` turned off, so a sequential scan only appears when
+no index can serve the query at all. The result therefore does not depend on how much data is
+loaded: on a small development database the planner would otherwise prefer sequential scans
+even where the production-volume plan uses an index.
+
+Modules:
+    - sqlalchemy: For running the `EXPLAIN` statements.
+    - loguru: For logging the results.
+    - database: Includes the engine configuration for SQLAlchemy.
+
+Usage:
+    python index_check.py
+"""
+
+import sys
+
+from loguru import logger
+from sqlalchemy import text
+
+from database import engine
+
+# Hot query shapes: name -> (table that must be read through an index, query)
+HOT_QUERIES = {
+    "track_click": (
+        "ab_test_results",
+        """
+        UPDATE ab_test_results SET clicked_link = TRUE
+        WHERE experiment_id = 1 AND ab_test_id = 1 AND customer_id = 1 AND clicked_link = FALSE
+        """,
+    ),
+    "ab_test_counts": (
+        "ab_test_results",
+        """
+        SELECT ab_test_id, COUNT(*), COUNT(*) FILTER (WHERE clicked_link)
+        FROM ab_test_results WHERE experiment_id = 1 GROUP BY ab_test_id
+        """,
+    ),
+    "segment_customers": (
+        "customer_segments",
+        "SELECT customer_id FROM customer_segments WHERE segment_id = 1",
+    ),
+    "customer_segment": (
+        "customer_segments",
+        "SELECT segment_id FROM customer_segments WHERE customer_id = 1",
+    ),
+    "customer_engagements": (
+        "engagements",
+        """
+        SELECT session_date, session_duration FROM engagements
+        WHERE customer_id = 1 AND session_date >= NOW() - INTERVAL '30 days'
+        """,
+    ),
+}
+
+
+def plan_nodes(plan):
+    """
+    Walk a JSON query plan, yielding every node.
+
+    **Parameters:**
+        - `plan (dict)`: A node of the plan returned by `EXPLAIN (FORMAT JSON)`.
+
+    **Yields:**
+        - `node (dict)`: The node itself, then all of its descendants.
+    """
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(connection, query):
+    """
+    Plan a query without running it, with sequential scans disabled.
+
+    **Parameters:**
+        - `connection (Connection)`: An open database connection.
+        - `query (str)`: The query to plan.
+
+    **Returns:**
+        - `nodes (list[dict])`: Every node of the plan.
+    """
+    connection.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar()
+    return list(plan_nodes(plan[0]["Plan"]))
+
+
+def check_indexes():
+    """
+    Check that every query in `HOT_QUERIES` reads its table through an index.
+
+    **Returns:**
+        - `failures (list[str])`: Names of the queries that still need a sequential scan.
+    """
+    failures = []
+    with engine.connect() as connection:
+        for name, (table, query) in HOT_QUERIES.items():
+            with connection.begin():
+                nodes = explain(connection, query)
+            scans = [node for node in nodes if node.get("Relation Name") == table]
+            if any(node["Node Type"] == "Seq Scan" for node in scans):
+                failures.append(name)
+                logger.warning(f"{name}: sequential scan on {table}")
+            else:
+                indexes = ", ".join(sorted({node["Index Name"] for node in nodes if "Index Name" in node}))
+                logger.info(f"{name}: {table} read through {indexes}")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check_indexes() else 0)